@@ -2,14 +2,37 @@ from django.contrib import admin
 from .models import *
 from guardian.admin import GuardedModelAdmin
 
+
+class SubtreeListFilter(admin.SimpleListFilter):
+    # Narrows the list to the entities below a top level entity, with one range query over the materialized path
+    title = 'subtree'
+    parameter_name = 'subtree'
+
+    def lookups(self, request, model_admin):
+        return Entity.get_top_model().objects.order_by('name').values_list('pk', 'name')
+
+    def queryset(self, request, queryset):
+        if not self.value() or not self.value().isdigit():
+            return queryset
+        entity = Entity.objects.filter(pk=self.value()).first()
+        return queryset.filter(entity.get_subtree_filter()) if entity else queryset.none()
+
+
+class EntityAdmin(GuardedModelAdmin):
+    list_display = ('name', 'path')
+    list_filter = (SubtreeListFilter,)
+    readonly_fields = ('path',)
+    ordering = ('path',) # Each entity follows its ancestors
+
+
 @admin.register(Organisation)
-class OrganisationAdmin(GuardedModelAdmin):
+class OrganisationAdmin(EntityAdmin):
     pass
 
 @admin.register(Business)
-class BusinessAdmin(GuardedModelAdmin):
+class BusinessAdmin(EntityAdmin):
     pass
 
 @admin.register(Branch)
-class BranchAdmin(GuardedModelAdmin):
+class BranchAdmin(EntityAdmin):
     pass
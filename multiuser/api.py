@@ -0,0 +1,268 @@
+from collections import defaultdict
+from hashlib import md5
+from itertools import product
+import csv
+import io
+import json
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.views.generic import View
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import ValidationError
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.conf import settings
+from .models import Invitation, Entity, Organisation, Business, Branch
+from .permissions import get_entity_perms
+from .etags import get_api_version
+from .views import KeysetPaginationMixin, entity_label
+from .tasks import send_invitation_emails
+
+# JSON API over the entities and invitations. Everything is read-only apart from the bulk invitation endpoint
+# ?fields=a,b,c limits the fields returned, ?depth=N nests the permitted children N levels deep,
+# and every response carries an ETag so pollers sending If-None-Match get a 304 when nothing has changed
+
+
+class ApiView(LoginRequiredMixin, View):
+    raise_exception = True # Respond 403 rather than redirecting to the login page
+    field_names = () # Fields returned when ?fields is not given, and the only ones that can be asked for
+
+    def get_fields(self):
+        fields = self.request.GET.get('fields')
+        if not fields:
+            return list(self.field_names)
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = set(fields) - set(self.field_names)
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+        return fields
+
+    def get_version_etag(self):
+        # With API_VERSION_ETAGS the ETag is known before get_data runs, see etags.py. The version is read first, so
+        # a change made while the response is built gives the next request a new ETag
+        if not settings.API_VERSION_ETAGS:
+            return None
+        return quote_etag(md5(f'{get_api_version()}:{self.request.user.pk}:{self.request.get_full_path()}'.encode()).hexdigest())
+
+    def finalize_response(self, response, etag):
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True) # Per-user data, always revalidate
+        return response
+
+    def render_json(self, data, etag=None):
+        body = json.dumps(data, cls=DjangoJSONEncoder)
+        if etag is None:
+            etag = quote_etag(md5(body.encode()).hexdigest())
+            response = get_conditional_response(self.request, etag=etag)
+            if response is not None:
+                return self.finalize_response(response, etag)
+        return self.finalize_response(HttpResponse(body, content_type='application/json'), etag)
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_version_etag()
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag)
+            if response is not None: # Nothing has changed, so skip the queries and serialization
+                return self.finalize_response(response, etag)
+        try:
+            return self.render_json(self.get_data(), etag)
+        except ValueError as e:
+            return HttpResponseBadRequest(json.dumps({'error': str(e)}), content_type='application/json')
+
+
+class EntityApiMixin:
+    model = None
+
+    @classmethod
+    def get_local_field_names(cls, model): # Fields of the subclass table, e.g. organisation_fields
+        return [field.name for field in model._meta.local_concrete_fields if not field.primary_key]
+
+    @classmethod
+    def get_model_field_names(cls, model):
+        return ['id', 'name', 'parent', 'type'] + cls.get_local_field_names(model)
+
+    @property
+    def field_names(self): # Fields of the current model and the models below it, so they can be asked for when nesting
+        names = []
+        model = self.model
+        while model is not None:
+            names += [name for name in self.get_model_field_names(model) if name not in names]
+            model = model.get_child_model()
+        return names
+
+    def get_depth(self):
+        depth = self.request.GET.get('depth', '0')
+        if not depth.isdigit():
+            raise ValueError('depth must be a non-negative integer')
+        return int(depth)
+
+    def get_queryset(self, model):
+        queryset = model.get_objects_for_user(self.request.user, settings.ENTITY_PERM_VIEW)
+        # Only load the columns that were asked for
+        local_fields = [field for field in self.get_fields() if field in self.get_local_field_names(model)]
+        return queryset.only('name', 'parent', *local_fields)
+
+    def expand(self, objects, depth):
+        # Attach the children the user can view to each object in subtree_children, one query per level
+        model = self.model
+        while depth > 0 and objects and not model.is_bottom():
+            model = model.get_child_model()
+            children = list(self.get_queryset(model).filter(parent__in=[obj.pk for obj in objects]).order_by('name', 'pk'))
+            children_by_parent = defaultdict(list)
+            for child in children:
+                children_by_parent[child.parent_id].append(child)
+            for obj in objects:
+                obj.subtree_children = children_by_parent[obj.pk]
+            objects, depth = children, depth - 1
+
+    def serialize(self, entity, fields):
+        values = {'id': entity.pk, 'name': entity.name, 'parent': entity.parent_id, 'type': entity._meta.model_name}
+        data = {}
+        for field in fields:
+            if field in values:
+                data[field] = values[field]
+            elif field in self.get_local_field_names(type(entity)):
+                data[field] = getattr(entity, field)
+        if hasattr(entity, 'subtree_children'):
+            data['children'] = [self.serialize(child, fields) for child in entity.subtree_children]
+        return data
+
+
+class EntityListApiView(EntityApiMixin, KeysetPaginationMixin, ApiView):
+    ordering_fields = ('name', 'pk')
+
+    def get_data(self):
+        fields = self.get_fields()
+        objects, next_cursor = self.paginate_keyset(self.get_queryset(self.model))
+        self.expand(objects, self.get_depth())
+        return {'results': [self.serialize(obj, fields) for obj in objects], 'next': next_cursor}
+
+
+class EntityDetailApiView(EntityApiMixin, ApiView):
+    def get_data(self):
+        fields = self.get_fields()
+        obj = self.get_queryset(self.model).filter(pk=self.kwargs['pk']).first()
+        if obj is None:
+            raise Http404
+        self.expand([obj], self.get_depth())
+        return self.serialize(obj, fields)
+
+
+class EntitySubtreeApiView(EntityApiMixin, ApiView):
+    # The entity and everything below it in a constant number of queries, with the user's permissions on each node
+
+    @property
+    def field_names(self):
+        names = ['id', 'name', 'parent', 'type', 'permissions']
+        for model in Entity.get_all_models():
+            names += self.get_local_field_names(model)
+        return names
+
+    def serialize(self, entity, fields):
+        data = super().serialize(entity, fields)
+        if 'permissions' in fields:
+            perms = [settings.ENTITY_PERM_VIEW, settings.ENTITY_PERM_CHANGE, settings.ENTITY_PERM_DELETE]
+            data['permissions'] = {perm: self.entity_perms.has_perm(entity, perm) for perm in perms}
+        return data
+
+    def get_data(self):
+        fields = self.get_fields()
+        root = Entity.get_entities_for_user(self.request.user, settings.ENTITY_PERM_VIEW).filter(pk=self.kwargs['pk']).first()
+        if root is None:
+            raise Http404
+        self.entity_perms = get_entity_perms(self.request.user)
+        return self.serialize(root.get_subtree(), fields)
+
+
+class InvitationListApiView(KeysetPaginationMixin, ApiView):
+    field_names = ('id', 'email', 'entity', 'entity_label', 'role', 'invited_by', 'accepted')
+
+    def get_queryset(self):
+        return Invitation.objects.none()
+
+    def serialize(self, invitation, fields):
+        values = {
+            'id': invitation.pk,
+            'email': invitation.email,
+            'entity': invitation.entity_id,
+            'entity_label': entity_label(invitation.entity) if 'entity_label' in fields else None,
+            'role': invitation.role,
+            'invited_by': invitation.invited_by.username,
+            'accepted': invitation.accepted,
+        }
+        return {field: values[field] for field in fields}
+
+    def get_data(self):
+        fields = self.get_fields()
+        queryset = self.get_queryset().select_related('invited_by')
+        if 'entity_label' in fields:
+            queryset = queryset.with_entities()
+        invitations, next_cursor = self.paginate_keyset(queryset)
+        return {'results': [self.serialize(invitation, fields) for invitation in invitations], 'next': next_cursor}
+
+
+class InvitationBulkCreateApiView(ApiView):
+    # POST either a CSV body with email,entity,role columns, or JSON with a list of
+    # {"email", "entity", "role"} objects under "invitations" and/or "emails", "entities" and "roles" lists whose every
+    # combination is invited. Pending duplicates are skipped and returned, nothing is created if any row is invalid
+    http_method_names = ['post']
+
+    def get_invitations(self):
+        if self.request.content_type == 'text/csv':
+            reader = csv.DictReader(io.StringIO(self.request.body.decode()))
+            return [(row.get('email', ''), row.get('entity', ''), row.get('role', '')) for row in reader]
+        try:
+            data = json.loads(self.request.body)
+            invitations = [(row['email'], row['entity'], row['role']) for row in data.get('invitations', [])]
+            invitations += list(product(data.get('emails', []), data.get('entities', []), data.get('roles', [])))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise ValueError('Expected a CSV body, or a JSON object with invitations or emails, entities and roles')
+        return invitations
+
+    def post(self, request, *args, **kwargs):
+        try:
+            created, skipped = Invitation.bulk_invite(request.user, self.get_invitations())
+        except (ValueError, ValidationError) as e:
+            errors = e.messages if isinstance(e, ValidationError) else [str(e)]
+            return HttpResponseBadRequest(json.dumps({'errors': errors}), content_type='application/json')
+        if created:
+            send_invitation_emails.delay([invitation.pk for invitation in created])
+        data = {
+            'created': [{'id': invitation.pk, 'email': invitation.email, 'entity': invitation.entity_id, 'role': invitation.role} for invitation in created],
+            'skipped': [{'email': email, 'entity': entity_id, 'role': role} for email, entity_id, role in skipped],
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json', status=201)
+
+
+class InvitationSentListApiView(InvitationListApiView):
+    def get_queryset(self):
+        return Invitation.objects.filter(invited_by=self.request.user).filter(accepted=False)
+
+
+class InvitationReceivedListApiView(InvitationListApiView):
+    def get_queryset(self):
+        return Invitation.objects.filter(email=self.request.user.email).filter(accepted=False)
+
+
+class OrganisationListApiView(EntityListApiView):
+    model = Organisation
+
+
+class OrganisationDetailApiView(EntityDetailApiView):
+    model = Organisation
+
+
+class BusinessListApiView(EntityListApiView):
+    model = Business
+
+
+class BusinessDetailApiView(EntityDetailApiView):
+    model = Business
+
+
+class BranchListApiView(EntityListApiView):
+    model = Branch
+
+
+class BranchDetailApiView(EntityDetailApiView):
+    model = Branch
@@ -6,4 +6,7 @@ class MultiuserConfig(AppConfig):
     name = 'multiuser'
 
     def ready(self):
-        import multiuser.signals  # noqa
\ No newline at end of file
+        import multiuser.signals  # noqa
+        import multiuser.checks  # noqa
+        from . import hierarchy
+        hierarchy.build()
\ No newline at end of file
@@ -0,0 +1,163 @@
+from django.shortcuts import render, redirect
+from django.http import Http404
+from django.contrib.auth.views import redirect_to_login
+from django.views.generic import View
+from django.core.paginator import Paginator, Page
+from django.conf import settings
+from .models import Invitation, Organisation, Business, Branch
+from .views import KeysetPaginationMixin, get_entity_members
+from .fragments import aget_fragment_version, aget_fragment
+from .tasks import record_invitation_accepted
+from asgiref.sync import sync_to_async
+
+# Async versions of the list, detail and invitation views, for running under ASGI without a thread hop per request
+# They render the same templates as their counterparts in views.py
+
+
+class AsyncLoginRequiredMixin:
+    async def dispatch(self, request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        request.user = user # So templates can use the user without a synchronous query
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncEntityListView(AsyncLoginRequiredMixin, KeysetPaginationMixin, View):
+    model = None
+    template_name = None
+    context_object_name = None
+    ordering_fields = ('name', 'pk')
+
+    async def get(self, request, *args, **kwargs):
+        queryset = await self.model.aget_objects_for_user(request.user, settings.ENTITY_PERM_VIEW)
+        objects, next_cursor = await self.apaginate_keyset(queryset)
+        context = {
+            self.context_object_name: objects,
+            'object_list': objects,
+            'next_cursor': next_cursor,
+            'is_first_page': not request.GET.get('after'),
+        }
+        return render(request, self.template_name, context)
+
+
+class AsyncEntityDetailView(AsyncLoginRequiredMixin, View):
+    model = None
+    template_name = None
+    context_object_name = None
+
+    async def get_members_page(self, entity):
+        # Paginator counts and slices synchronously, so count and fetch the page here and hand it a stand-in list
+        members = get_entity_members(entity, exclude_user=self.request.user)
+        paginator = Paginator(range(await members.acount()), settings.LIST_PAGE_SIZE)
+        number = paginator.get_page(self.request.GET.get('users_page')).number
+        start = (number - 1) * paginator.per_page
+        return Page([member async for member in members[start:start + paginator.per_page]], number, paginator)
+
+    async def get(self, request, *args, **kwargs):
+        queryset = await self.model.aget_objects_for_user(request.user, settings.ENTITY_PERM_VIEW)
+        try:
+            entity = await queryset.aget(pk=kwargs['pk'])
+        except self.model.DoesNotExist:
+            raise Http404
+
+        context = {
+            self.context_object_name: entity,
+            'object': entity,
+            'can_change': await entity.auser_has_perm(request.user, settings.ENTITY_PERM_CHANGE),
+            'can_delete': await entity.auser_has_perm(request.user, settings.ENTITY_PERM_DELETE),
+            'fragment_cache_timeout': settings.FRAGMENT_CACHE_TIMEOUT,
+            'fragment_version': await aget_fragment_version(entity),
+        }
+        # Templates can't run queries in an async view, so the children and members are fetched up front, unless
+        # the fragments that list them are cached, in which case the cached HTML is handed to the template as is
+        # The vary_on values match the {% cache %} tags of entity_children.html and entity_users.html
+        version = context['fragment_version']
+        if not self.model.is_bottom():
+            context['children_fragment'] = await aget_fragment('entity_children', entity.pk, version)
+            if context['children_fragment'] is None:
+                context['children'] = [child async for child in self.model.get_child_model().objects.filter(parent=entity)]
+        if context['can_change']:
+            context['members_fragment'] = await aget_fragment('entity_users', entity.pk, version, request.user.pk, request.GET.get('users_page', ''))
+            if context['members_fragment'] is None:
+                context['members'] = await self.get_members_page(entity)
+            context['removeuser_url_name'] = f'{self.model._meta.model_name}_removeuser'
+        return render(request, self.template_name, context)
+
+
+class AsyncInvitationListView(AsyncLoginRequiredMixin, KeysetPaginationMixin, View):
+    template_name = None
+
+    def get_queryset(self):
+        return Invitation.objects.none()
+
+    async def get(self, request, *args, **kwargs):
+        invitations, next_cursor = await self.apaginate_keyset(self.get_queryset())
+        context = {
+            'invitations': invitations,
+            'next_cursor': next_cursor,
+            'is_first_page': not request.GET.get('after'),
+        }
+        return render(request, self.template_name, context)
+
+
+class AsyncInvitationSentListView(AsyncInvitationListView):
+    template_name = 'invitation_sent_list.html'
+
+    def get_queryset(self):
+        return Invitation.objects.filter(invited_by=self.request.user).filter(accepted=False).with_entities()
+
+
+class AsyncInvitationReceivedListView(AsyncInvitationListView):
+    template_name = 'invitation_received_list.html'
+
+    def get_queryset(self):
+        queryset = Invitation.objects.filter(email=self.request.user.email).filter(accepted=False)
+        return queryset.select_related('invited_by').with_entities()
+
+
+class AsyncInvitationAcceptView(AsyncLoginRequiredMixin, View):
+    async def post(self, request, *args, **kwargs):
+        # Only the invitee can accept, and only while the invitation is pending. Goes through the same transaction as
+        # the sync view, so the invitation is never left accepted without the membership
+        invitations = Invitation.objects.filter(pk=kwargs['pk'], email=request.user.email)
+        if not await sync_to_async(invitations.accept)(request.user):
+            raise Http404
+        await sync_to_async(record_invitation_accepted.delay)(kwargs['pk'], request.user.pk)
+        return redirect('invitationreceived_list')
+
+
+class AsyncOrganisationListView(AsyncEntityListView):
+    model = Organisation
+    template_name = 'organisation_list.html'
+    context_object_name = 'organisations'
+
+
+class AsyncOrganisationDetailView(AsyncEntityDetailView):
+    model = Organisation
+    template_name = 'organisation_detail.html'
+    context_object_name = 'organisation'
+
+
+class AsyncBusinessListView(AsyncEntityListView):
+    model = Business
+    template_name = 'business_list.html'
+    context_object_name = 'businesses'
+
+
+class AsyncBusinessDetailView(AsyncEntityDetailView):
+    model = Business
+    template_name = 'business_detail.html'
+    context_object_name = 'business'
+
+
+class AsyncBranchListView(AsyncEntityListView):
+    model = Branch
+    template_name = 'branch_list.html'
+    context_object_name = 'branches'
+
+
+class AsyncBranchDetailView(AsyncEntityDetailView):
+    model = Branch
+    template_name = 'branch_detail.html'
+    context_object_name = 'branch'
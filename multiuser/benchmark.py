@@ -0,0 +1,198 @@
+import json
+import random
+import statistics
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import CharField
+from django.test import Client
+from django.urls import reverse
+from .models import Entity, EntityRoleGroup, Invitation
+from .permissions import invalidate_entity_perms
+from .fragments import invalidate_fragments
+from .instrumentation import RequestMetrics
+
+# Synthetic data and measurements for the query count and latency benchmarks, used by `manage.py benchmark_views`,
+# `manage.py generate_platter_data` and tests.py
+
+
+def build_hierarchy(sizes, users, seed=0, memberships=3, invitations=2, batch_size=1000, log=None):
+    # sizes gives the number of entities per parent at each hierarchy level, e.g. [10, 5, 5] for 10 organisations
+    # with 5 businesses each with 5 branches. Everything is created by one owner, who is admin of every entity.
+    # Each of the users joins up to memberships groups at random levels and receives up to invitations pending
+    # invitations. The same arguments always produce the same data. Rows are inserted in batches of batch_size,
+    # each in its own transaction, and only ids are kept in memory so millions of rows can be generated
+    rng = random.Random(seed)
+    owner, created = User.objects.get_or_create(username='benchmark-owner', defaults={'email': 'owner@benchmark.test'})
+
+    entity_ids_by_level = []
+    parent_ids = [None]
+    for model, size in zip(Entity.get_all_models(), sizes):
+        entity_ids = []
+        parents_per_batch = max(1, batch_size // max(size, 1))
+        for start in range(0, len(parent_ids), parents_per_batch):
+            objs = []
+            for parent_id in parent_ids[start:start + parents_per_batch]:
+                for i in range(size):
+                    name = f'{model.__name__} {seed}-{parent_id or 0}-{i}'
+                    obj = model(name=name, parent_id=parent_id, created_by=owner)
+                    for field in model._meta.local_concrete_fields:
+                        if isinstance(field, CharField):
+                            setattr(obj, field.attname, name)
+                    objs.append(obj)
+            entity_ids += [obj.pk for obj in model.bulk_create_with_groups(objs, batch_size=batch_size)]
+        if log:
+            log(f'Created {len(entity_ids)} {model.__name__} entities')
+        entity_ids_by_level.append(entity_ids)
+        parent_ids = entity_ids
+
+    entity_ids_by_level = [entity_ids for entity_ids in entity_ids_by_level if entity_ids]
+    roles = list(settings.ENTITY_ROLES)
+    for start in range(0, users, batch_size):
+        with transaction.atomic():
+            members = User.objects.bulk_create([
+                User(username=f'benchmark-{seed}-{i}', email=f'user{i}@{seed}.benchmark.test') for i in range(start, min(start + batch_size, users))
+            ])
+            if not entity_ids_by_level:
+                continue
+            # Pick the grants first, then look their groups up for the whole batch in one query
+            grants = [
+                (member, rng.choice(rng.choice(entity_ids_by_level)), rng.choice(roles))
+                for member in members
+                for j in range(rng.randint(1, memberships))
+            ]
+            role_groups = EntityRoleGroup.objects.filter(entity_id__in={entity_id for member, entity_id, role in grants})
+            group_ids = {(entity_id, role): group_id for entity_id, role, group_id in role_groups.values_list('entity_id', 'role', 'group_id')}
+            User.groups.through.objects.bulk_create([
+                User.groups.through(user_id=member.pk, group_id=group_ids[entity_id, role])
+                for member, entity_id, role in grants
+                if (entity_id, role) in group_ids
+            ], ignore_conflicts=True)
+            pending = dict.fromkeys( # Deduplicated, as only one invitation per email, entity and role can be pending
+                (member.email, rng.choice(rng.choice(entity_ids_by_level)), rng.choice(roles))
+                for member in members
+                for j in range(rng.randint(0, invitations))
+            )
+            Invitation.objects.bulk_create([
+                Invitation(email=email, entity_id=entity_id, role=role, invited_by=owner) for email, entity_id, role in pending
+            ])
+    if log:
+        log(f'Created {users} users')
+    invalidate_entity_perms()
+    invalidate_fragments() # The memberships were bulk inserted, without m2m_changed signals
+    return owner, User.objects.filter(username__startswith=f'benchmark-{seed}-').order_by('pk')
+
+
+def get_benchmark_urls(user):
+    # The list and detail views of every hierarchy level and the invitation views, as (name, url) pairs
+    urls = []
+    for model in Entity.get_all_models():
+        model_name = model.__name__.lower()
+        urls.append((f'{model_name}_list', reverse(f'{model_name}_list')))
+        obj = model.get_objects_for_user(user, settings.ENTITY_PERM_VIEW).order_by('pk').first()
+        if obj is not None:
+            urls.append((f'{model_name}_detail', reverse(f'{model_name}_detail', kwargs={'pk': obj.pk})))
+    urls += [(name, reverse(name)) for name in ['invitation_create', 'invitationsent_list', 'invitationreceived_list']]
+    return urls
+
+
+def measure(client, url, repeat=5):
+    # Returns the number of queries of the slowest request, and the median SQL and wall time in milliseconds
+    samples = []
+    for i in range(repeat):
+        # Timed with perf_counter, since the times Django logs for each query are rounded to the millisecond
+        metrics = RequestMetrics()
+        with connection.execute_wrapper(metrics.execute_wrapper):
+            start = time.perf_counter()
+            response = client.get(url)
+            wall_time = time.perf_counter() - start
+        if response.status_code != 200:
+            raise AssertionError(f'GET {url} returned {response.status_code}')
+        samples.append((metrics.queries, metrics.db_time, wall_time))
+    return {
+        'queries': max(queries for queries, sql_time, wall_time in samples),
+        'sql_ms': round(statistics.median(sql_time for queries, sql_time, wall_time in samples) * 1000, 3),
+        'wall_ms': round(statistics.median(wall_time for queries, sql_time, wall_time in samples) * 1000, 3),
+    }
+
+
+def run_benchmark(users, repeat=5):
+    # Measures every benchmark url for each of the users
+    results = []
+    for user in users:
+        client = Client()
+        client.force_login(user)
+        for name, url in get_benchmark_urls(user):
+            results.append({'view': name, 'user': user.username, 'url': url, **measure(client, url, repeat)})
+    return results
+
+
+def run_concurrent_benchmark(owner, members, iterations=20):
+    # One thread per member, each repeatedly having the owner invite the member to a random entity, accepting
+    # all of the member's invitations and loading a list view, to measure how the database copes with concurrent
+    # writes. Returns the wall time percentiles of each operation in milliseconds, and the number of errors
+    entity_ids = list(Entity.objects.values_list('pk', flat=True))
+    role = settings.ENTITY_ROLE_USER
+    timings = {'invite': [], 'accept': [], 'list': []}
+    errors = []
+    lock = threading.Lock()
+
+    def worker(member, seed):
+        rng = random.Random(seed)
+        owner_client, member_client = Client(), Client()
+        owner_client.force_login(owner)
+        member_client.force_login(member)
+        requests = [
+            ('invite', lambda: owner_client.post(
+                reverse('api_invitation_bulk_create'),
+                json.dumps({'emails': [member.email], 'entities': [rng.choice(entity_ids)], 'roles': [role]}),
+                content_type='application/json',
+            )),
+            ('accept', lambda: member_client.post(reverse('invitation_bulk_accept'), {'all': ''})),
+            ('list', lambda: member_client.get(reverse(f'{Entity.get_bottom_model().__name__.lower()}_list'))),
+        ]
+        try:
+            for i in range(iterations):
+                for name, request in requests:
+                    start = time.perf_counter()
+                    try:
+                        response = request()
+                        error = None if response.status_code < 400 else f'{name} returned {response.status_code}'
+                    except Exception as e:
+                        error = f'{name} raised {e!r}'
+                    with lock:
+                        timings[name].append(time.perf_counter() - start)
+                        if error:
+                            errors.append(error)
+        finally:
+            connection.close() # Each thread has its own connection
+
+    threads = [threading.Thread(target=worker, args=(member, i)) for i, member in enumerate(members)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+
+    def percentile(samples, fraction):
+        return round(sorted(samples)[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 3) if samples else None
+
+    return {
+        'threads': len(members),
+        'iterations': iterations,
+        'requests_per_second': round(sum(len(samples) for samples in timings.values()) / wall_time, 1),
+        'operations': {
+            name: {'p50_ms': percentile(samples, 0.5), 'p95_ms': percentile(samples, 0.95)} for name, samples in timings.items()
+        },
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:10],
+    }
+
+
+def compare_results(previous, current):
+    # Pairs up the results of two runs by view and user, returning (result, previous result) pairs
+    previous_by_key = {(result['view'], result['user']): result for result in previous}
+    return [(result, previous_by_key.get((result['view'], result['user']))) for result in current]
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+@register()
+def check_production_settings(app_configs, **kwargs):
+    # Development-only apps and settings that add overhead to every request when they leak into production
+    if getattr(settings, 'PLATTER_ENV', None) != 'prod':
+        return []
+    warnings = []
+    if settings.DEBUG:
+        warnings.append(Warning(
+            'DEBUG is on in production.',
+            hint='Every executed query is kept in memory on its connection while DEBUG is on.',
+            id='multiuser.W001',
+        ))
+    if 'debug_toolbar' in settings.INSTALLED_APPS:
+        warnings.append(Warning('debug_toolbar is installed in production.', id='multiuser.W002'))
+    if any(middleware.startswith('debug_toolbar.') for middleware in settings.MIDDLEWARE):
+        warnings.append(Warning('DebugToolbarMiddleware is in MIDDLEWARE in production.', id='multiuser.W003'))
+    db_logger = getattr(settings, 'LOGGING', {}).get('loggers', {}).get('django.db.backends', {})
+    if db_logger.get('level') == 'DEBUG':
+        warnings.append(Warning(
+            'The django.db.backends logger is at DEBUG level in production.',
+            hint='It logs every query.',
+            id='multiuser.W004',
+        ))
+    if settings.INSTRUMENTATION_SERVER_TIMING:
+        warnings.append(Warning(
+            'INSTRUMENTATION_SERVER_TIMING is on in production.',
+            hint='It sends database and permission timings to every client.',
+            id='multiuser.W005',
+        ))
+    local_caches = {alias for alias, cache in settings.CACHES.items() if cache['BACKEND'] == 'django.core.cache.backends.locmem.LocMemCache'}
+    fragment_cache = 'template_fragments' if 'template_fragments' in settings.CACHES else 'default'
+    for name, timeout, alias in [
+        ('ENTITY_PERMS_CACHE_TIMEOUT', settings.ENTITY_PERMS_CACHE_TIMEOUT, 'default'),
+        ('FRAGMENT_CACHE_TIMEOUT', settings.FRAGMENT_CACHE_TIMEOUT, fragment_cache),
+        ('API_VERSION_ETAGS', settings.API_VERSION_ETAGS, 'default'),
+    ]:
+        if timeout and alias in local_caches:
+            warnings.append(Warning(
+                f'{name} is set but the "{alias}" cache is local to each process.',
+                hint='Invalidations only reach the process that made them. Set PLATTER_CACHE_LOCATION to a shared cache.',
+                id='multiuser.W006',
+            ))
+    return warnings
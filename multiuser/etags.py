@@ -0,0 +1,24 @@
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache
+
+# Version of the data behind the JSON API, so that api.py can answer If-None-Match with a 304 from one cache read,
+# before running any query. Bumped by invalidate_entity_perms and invalidate_fragments, which every change to the
+# entities, memberships and permissions already goes through, and by every change to the pending invitations
+# Coarse on purpose: any change makes every poller fetch a full response once
+
+VERSION_KEY = 'multiuser:api:version'
+
+
+def get_api_version():
+    version = cache.get(VERSION_KEY)
+    if version is None: # Never set or evicted, so start a new version rather than fall back to one a client may hold
+        version = uuid4().hex
+        if not cache.add(VERSION_KEY, version, None):
+            version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def invalidate_api_version():
+    if settings.API_VERSION_ETAGS:
+        cache.set(VERSION_KEY, uuid4().hex, None)
@@ -0,0 +1,61 @@
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache, caches, InvalidCacheBackendError
+from django.core.cache.utils import make_template_fragment_key
+from django.utils.safestring import mark_safe
+from .etags import invalidate_api_version
+
+# Versions for the {% cache %} fragments of the entity pages. A fragment is keyed by the versions of the entity and
+# of each of its ancestors, so that bumping an entity's version refreshes its own fragments and those of everything
+# below it, e.g. when a membership of one of its groups changes and the users panels below list it as inherited
+
+VERSION_KEY = 'multiuser:fragments:version'
+ENTITY_VERSION_KEY = 'multiuser:fragments:version:{entity_pk}'
+
+
+def get_version_keys(ancestor_ids):
+    return [VERSION_KEY] + [ENTITY_VERSION_KEY.format(entity_pk=ancestor_id) for ancestor_id in sorted(ancestor_ids)]
+
+
+def get_fragment_version(entity): # The entity's ancestors are read from its materialized path, without a query
+    if not settings.FRAGMENT_CACHE_TIMEOUT:
+        return None
+    keys = get_version_keys(entity.get_ancestor_ids(include_self=True))
+    versions = cache.get_many(keys)
+    return '-'.join(str(versions.get(key, 0)) for key in keys)
+
+
+async def aget_fragment_version(entity): # Async version of get_fragment_version
+    if not settings.FRAGMENT_CACHE_TIMEOUT:
+        return None
+    keys = get_version_keys(entity.get_ancestor_ids(include_self=True))
+    versions = await cache.aget_many(keys)
+    return '-'.join(str(versions.get(key, 0)) for key in keys)
+
+
+def invalidate_fragments(entity_ids=None):
+    # Pass the ids of the entities whose fragments changed, or nothing to invalidate every fragment
+    invalidate_api_version()
+    if not settings.FRAGMENT_CACHE_TIMEOUT:
+        return
+    if entity_ids is None:
+        cache.set(VERSION_KEY, uuid4().hex, None)
+    else:
+        cache.set_many({ENTITY_VERSION_KEY.format(entity_pk=entity_id): uuid4().hex for entity_id in entity_ids if entity_id is not None}, None)
+
+
+def get_fragment_cache(): # The cache the {% cache %} tag uses
+    try:
+        return caches['template_fragments']
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+async def aget_fragment(fragment_name, *vary_on):
+    # The HTML of the {% cache fragment_name *vary_on %} fragment, or None if it isn't cached. The async views pass it
+    # to the template themselves and only fetch the fragment's data on a miss, since the fragment could be evicted
+    # between checking for it and rendering the template
+    if not settings.FRAGMENT_CACHE_TIMEOUT:
+        return None
+    html = await get_fragment_cache().aget(make_template_fragment_key(fragment_name, vary_on))
+    return None if html is None else mark_safe(html)
@@ -0,0 +1,60 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Filled in once by MultiuserConfig.ready() from settings.ENTITY_HIERARCHY
+levels = {} # Entity model -> HierarchyLevel
+all_models = [] # Entity models, top down
+
+
+class HierarchyLevel:
+    # Everything about a model's place in the hierarchy, precomputed so the Entity classmethods are plain lookups
+    def __init__(self, model, rank, parent_model, child_model, lineage):
+        self.model = model
+        self.rank = rank
+        self.parent_model = parent_model
+        self.child_model = child_model
+        self.is_top = parent_model is None
+        self.is_bottom = child_model is None
+        self.lineage = lineage # The model followed by its ancestor models, bottom up
+        # Permission codenames for the model and its ancestor models, e.g. {'view': ['view_branch', 'view_business', 'view_organisation']}
+        perms = {perm for role_data in settings.ENTITY_ROLES.values() for perm in role_data['permissions']}
+        self.codenames = {perm: self.build_codenames(perm) for perm in perms}
+
+    def build_codenames(self, perm):
+        return [f'{perm}_{model._meta.model_name}' for model in self.lineage]
+
+    def get_codenames(self, perm):
+        codenames = self.codenames.get(perm)
+        return codenames if codenames is not None else self.build_codenames(perm)
+
+
+def build():
+    names = settings.ENTITY_HIERARCHY
+    if not names:
+        raise ImproperlyConfigured('ENTITY_HIERARCHY must list at least one model')
+    if len(set(names)) != len(names):
+        raise ImproperlyConfigured('ENTITY_HIERARCHY must not list a model more than once')
+    if settings.ENTITY_ROLE_ADMIN not in settings.ENTITY_ROLES:
+        raise ImproperlyConfigured('ENTITY_ROLES must define the ENTITY_ROLE_ADMIN role')
+
+    Entity = apps.get_model('multiuser', 'Entity')
+    models = []
+    for name in names:
+        try:
+            model = apps.get_model('multiuser', name)
+        except LookupError:
+            raise ImproperlyConfigured(f'ENTITY_HIERARCHY refers to "{name}", which is not a model of the multiuser app')
+        if not issubclass(model, Entity) or model is Entity:
+            raise ImproperlyConfigured(f'ENTITY_HIERARCHY refers to "{name}", which is not a subclass of Entity')
+        models.append(model)
+    unlisted = [model.__name__ for model in apps.get_app_config('multiuser').get_models() if issubclass(model, Entity) and model is not Entity and model not in models]
+    if unlisted:
+        raise ImproperlyConfigured(f'ENTITY_HIERARCHY is missing the Entity models {", ".join(unlisted)}')
+
+    levels.clear()
+    for rank, model in enumerate(models):
+        parent_model = models[rank - 1] if rank > 0 else None
+        child_model = models[rank + 1] if rank < len(models) - 1 else None
+        levels[model] = HierarchyLevel(model, rank, parent_model, child_model, models[rank::-1])
+    all_models[:] = models
@@ -0,0 +1,150 @@
+import functools
+import inspect
+import logging
+import random
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+logger = logging.getLogger(__name__)
+
+# Per-request metrics collected by InstrumentationMiddleware for a sample of the requests: number of queries and
+# database time, time spent in the functions decorated with @timed, and counters bumped with count()
+# Outside a sampled request timed and count do nothing beyond one context variable lookup
+# The perms timer covers compute_entity_perms only. Entity.get_objects_for_user and get_entities_for_user build lazy
+# querysets, whose permission SQL runs when the view evaluates them and so counts towards db rather than perms
+
+current_metrics = ContextVar('multiuser_request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.timers = defaultdict(float) # Name -> seconds
+        self.counters = defaultdict(int)
+        self.running = set() # Names of the timers running, so nested calls aren't counted twice
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+def count(name, value=1):
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.counters[name] += value
+
+
+def timed(name):
+    # Adds the time spent in the decorated function or coroutine function to the timer name
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                metrics = current_metrics.get()
+                if metrics is None or name in metrics.running:
+                    return await func(*args, **kwargs)
+                metrics.running.add(name)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    metrics.timers[name] += time.perf_counter() - start
+                    metrics.running.discard(name)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                metrics = current_metrics.get()
+                if metrics is None or name in metrics.running:
+                    return func(*args, **kwargs)
+                metrics.running.add(name)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    metrics.timers[name] += time.perf_counter() - start
+                    metrics.running.discard(name)
+        return wrapper
+    return decorator
+
+
+class InstrumentationMiddleware:
+    # Logs one line per sampled request to the multiuser.instrumentation logger, and adds a Server-Timing header
+    # when INSTRUMENTATION_SERVER_TIMING is set. INSTRUMENTATION_SAMPLE_RATE is the fraction of requests sampled
+    # Works in both sync and async chains, so that it doesn't make Django adapt the async views under ASGI
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def wrap_connections(self, metrics): # Returns an ExitStack that unwraps them again
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(metrics.execute_wrapper))
+        return stack
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if random.random() >= settings.INSTRUMENTATION_SAMPLE_RATE:
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with self.wrap_connections(metrics):
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        return self.report(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        if random.random() >= settings.INSTRUMENTATION_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            # Connections belong to a thread, and the async ORM runs its queries in the request's sync thread
+            stack = await sync_to_async(self.wrap_connections)(metrics)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(stack.close)()
+        finally:
+            current_metrics.reset(token)
+        return self.report(request, response, metrics, time.perf_counter() - start)
+
+    def report(self, request, response, metrics, total_time):
+        timers = {'db': metrics.db_time, **metrics.timers, 'total': total_time}
+        logger.info(
+            'method=%s path=%s status=%s queries=%s %s %s',
+            request.method,
+            request.path,
+            response.status_code,
+            metrics.queries,
+            ' '.join(f'{name}_ms={seconds * 1000:.1f}' for name, seconds in timers.items()),
+            ' '.join(f'{name}={value}' for name, value in sorted(metrics.counters.items())),
+            extra={'queries': metrics.queries, 'timers': dict(timers), 'counters': dict(metrics.counters)},
+        )
+        if settings.INSTRUMENTATION_SERVER_TIMING:
+            entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in timers.items()]
+            entries[0] += f';desc="{metrics.queries} queries"'
+            entries += [f'{name};desc="{value}"' for name, value in sorted(metrics.counters.items())]
+            response['Server-Timing'] = ', '.join(entries)
+        return response
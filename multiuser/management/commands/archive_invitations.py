@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from multiuser.models import Invitation, ArchivedInvitation
+
+
+class Command(BaseCommand):
+    help = 'Moves accepted invitations out of the Invitation table into ArchivedInvitation, or deletes them with --purge'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--purge', action='store_true', help='Delete accepted invitations without archiving them')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        accepted = Invitation.objects.filter(accepted=True).order_by('pk')
+        total = 0
+        while True:
+            # Each batch is copied and deleted in its own transaction so the table is never locked for long
+            with transaction.atomic():
+                batch = list(accepted.values('id', 'email', 'entity_id', 'role', 'invited_by_id')[:options['batch_size']])
+                if not batch:
+                    break
+                invitation_ids = [row['id'] for row in batch]
+                if not options['purge']:
+                    ArchivedInvitation.objects.bulk_create(
+                        [ArchivedInvitation(invitation_id=row.pop('id'), **row) for row in batch],
+                        ignore_conflicts=True, # Already archived by an interrupted run
+                    )
+                Invitation.objects.filter(pk__in=invitation_ids).delete()
+            total += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'{"Purged" if options["purge"] else "Archived"} {total} accepted invitations'))
@@ -0,0 +1,91 @@
+import json
+import platform
+import tempfile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from multiuser.benchmark import build_hierarchy, run_benchmark, run_concurrent_benchmark, compare_results
+
+
+class Command(BaseCommand):
+    help = (
+        'Builds a synthetic hierarchy in a throwaway test database and measures the queries, SQL time and wall time '
+        'of the entity and invitation views, writing the results to a JSON file'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 5, 5], help='Entities per parent at each hierarchy level')
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--measured-users', type=int, default=3, help='Number of the users to measure the views for, besides the owner')
+        parser.add_argument('--repeat', type=int, default=5, help='Requests per view')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--concurrency', type=int, default=0, help='Threads for the concurrent invite/accept benchmark, 0 to skip it')
+        parser.add_argument('--iterations', type=int, default=20, help='Invite/accept/list rounds per thread')
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        if len(options['sizes']) != len(settings.ENTITY_HIERARCHY):
+            raise CommandError(f'--sizes needs one value per hierarchy level ({", ".join(settings.ENTITY_HIERARCHY)})')
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+
+        # SQLite test databases are in memory by default, where locking and the pragmas behave nothing like a file
+        test_dir = tempfile.TemporaryDirectory()
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+            connection.settings_dict['TEST']['NAME'] = f'{test_dir.name}/benchmark.sqlite3'
+
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        try:
+            owner, members = build_hierarchy(options['sizes'], options['users'], seed=options['seed'])
+            results = run_benchmark([owner, *members[:options['measured_users']]], repeat=options['repeat'])
+            concurrency = None
+            if options['concurrency']:
+                concurrency = run_concurrent_benchmark(owner, list(members[:options['concurrency']]), iterations=options['iterations'])
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+            test_dir.cleanup()
+
+        data = {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'sqlite_pragmas': settings.SQLITE_PRAGMAS if connection.vendor == 'sqlite' else None,
+            'config': {key: options[key] for key in ['sizes', 'users', 'measured_users', 'repeat', 'seed', 'concurrency', 'iterations']},
+            'results': results,
+            'concurrency': concurrency,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(data, f, indent=2)
+
+        for result, previous_result in compare_results(previous.get('results', []), results):
+            line = f'{result["view"]:<28} {result["user"]:<20} {result["queries"]:>4} queries {result["sql_ms"]:>9} ms SQL {result["wall_ms"]:>9} ms'
+            if previous_result is not None:
+                line += f'  ({result["queries"] - previous_result["queries"]:+d} queries, {result["wall_ms"] - previous_result["wall_ms"]:+.3f} ms)'
+            if previous_result is not None and result['queries'] > previous_result['queries']:
+                self.stdout.write(self.style.WARNING(line))
+            else:
+                self.stdout.write(line)
+        if concurrency:
+            previous_concurrency = previous.get('concurrency') or {}
+            line = f'{concurrency["threads"]} threads: {concurrency["requests_per_second"]} requests/s, {concurrency["errors"]} errors'
+            if previous_concurrency:
+                line += f' (was {previous_concurrency["requests_per_second"]} requests/s, {previous_concurrency["errors"]} errors)'
+            self.stdout.write(line)
+            for name, timing in concurrency['operations'].items():
+                line = f'  {name:<8} p50 {timing["p50_ms"]} ms, p95 {timing["p95_ms"]} ms'
+                if name in previous_concurrency.get('operations', {}):
+                    previous_timing = previous_concurrency['operations'][name]
+                    line += f' (was p50 {previous_timing["p50_ms"]} ms, p95 {previous_timing["p95_ms"]} ms)'
+                self.stdout.write(line)
+            for error in concurrency['error_samples']:
+                self.stdout.write(self.style.WARNING(f'  {error}'))
+        self.stdout.write(self.style.SUCCESS(f'Wrote {len(results)} results to {options["output"]}'))
@@ -0,0 +1,34 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from multiuser.benchmark import build_hierarchy
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates a synthetic hierarchy with bulk inserts: entities with their groups and object permissions, '
+        'users with memberships at random levels and pending invitations. The same options always generate the same data'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10, 10], help='Entities per parent at each hierarchy level')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--memberships', type=int, default=3, help='Maximum groups per user')
+        parser.add_argument('--invitations', type=int, default=2, help='Maximum pending invitations per user')
+        parser.add_argument('--seed', type=int, default=0, help='Also prefixes the usernames, so use a new seed to add more data')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if len(options['sizes']) != len(settings.ENTITY_HIERARCHY):
+            raise CommandError(f'--sizes needs one value per hierarchy level ({", ".join(settings.ENTITY_HIERARCHY)})')
+        start = time.perf_counter()
+        build_hierarchy(
+            options['sizes'],
+            options['users'],
+            seed=options['seed'],
+            memberships=options['memberships'],
+            invitations=options['invitations'],
+            batch_size=options['batch_size'],
+            log=self.stdout.write,
+        )
+        self.stdout.write(self.style.SUCCESS(f'Generated the data in {time.perf_counter() - start:.1f}s'))
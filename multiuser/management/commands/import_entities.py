@@ -0,0 +1,50 @@
+import csv
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from multiuser.tasks import provision_entities
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates entities of one hierarchy level from a CSV file, provisioning their groups and permissions in batches. '
+        'The CSV needs a name column, a parent column (the parent entity id, empty for top level entities) '
+        'and one column per field of the model, e.g. name,parent,branch_fields'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=settings.ENTITY_HIERARCHY)
+        parser.add_argument('csv_file')
+        parser.add_argument('--created-by', required=True, help='Username of the user added to the admin group of every new entity')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--background', action='store_true', help='Queue the import as a background task instead of running it now')
+
+    def handle(self, *args, **options):
+        model = apps.get_model('multiuser', options['model'])
+        user = User.objects.filter(username=options['created_by']).first()
+        if user is None:
+            raise CommandError(f'User "{options["created_by"]}" does not exist')
+
+        objs = []
+        with open(options['csv_file'], newline='') as csv_file:
+            for line, row in enumerate(csv.DictReader(csv_file), start=2):
+                parent_id = row.pop('parent', '') or None
+                try:
+                    objs.append(model(created_by=user, parent_id=parent_id, **row))
+                except TypeError as e:
+                    raise CommandError(f'Line {line}: {e}')
+
+        try:
+            model.validate_parents(objs)
+        except ValidationError as e:
+            raise CommandError('; '.join(e.messages))
+
+        if options['background']:
+            rows = [{'parent_id': obj.parent_id, **{field.attname: getattr(obj, field.attname) for field in model._meta.local_concrete_fields if not field.primary_key}, 'name': obj.name} for obj in objs]
+            provision_entities.delay(model.__name__, rows, user.pk, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Queued {len(objs)} {model.__name__} entities'))
+            return
+        model.bulk_create_with_groups(objs, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Created {len(objs)} {model.__name__} entities'))
@@ -0,0 +1,44 @@
+import csv
+from itertools import product
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError, PermissionDenied
+from django.core.management.base import BaseCommand, CommandError
+from multiuser.models import Invitation
+from multiuser.tasks import send_invitation_emails
+
+
+class Command(BaseCommand):
+    help = (
+        'Invites users to entities in bulk, either from a CSV file with email,entity,role columns '
+        'or every combination of --emails, --entities and --roles. Pending duplicates are skipped'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', nargs='?')
+        parser.add_argument('--emails', nargs='+', default=[])
+        parser.add_argument('--entities', nargs='+', default=[], help='Entity ids')
+        parser.add_argument('--roles', nargs='+', default=[])
+        parser.add_argument('--invited-by', required=True, help='Username of the user sending the invitations, who needs change permission on the entities')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['invited_by']).first()
+        if user is None:
+            raise CommandError(f'User "{options["invited_by"]}" does not exist')
+
+        invitations = list(product(options['emails'], options['entities'], options['roles']))
+        if options['csv_file']:
+            with open(options['csv_file'], newline='') as csv_file:
+                invitations += [(row['email'], row['entity'], row['role']) for row in csv.DictReader(csv_file)]
+        if not invitations:
+            raise CommandError('Give a CSV file, or --emails, --entities and --roles')
+
+        try:
+            created, skipped = Invitation.bulk_invite(user, invitations, batch_size=options['batch_size'])
+        except ValidationError as e:
+            raise CommandError('; '.join(e.messages))
+        except PermissionDenied as e:
+            raise CommandError(str(e))
+        if created:
+            send_invitation_emails.delay([invitation.pk for invitation in created])
+        self.stdout.write(self.style.SUCCESS(f'Created {len(created)} invitations, skipped {len(skipped)} already pending'))
@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand
+from multiuser.tasks import run_pending_tasks
+
+# Worker for tasks.DatabaseBackend, e.g. python manage.py run_tasks --sleep 5
+
+
+class Command(BaseCommand):
+    help = 'Runs background tasks queued in the Task table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the tasks that are due and exit')
+        parser.add_argument('--sleep', type=float, default=2, help='Seconds to wait when no task is due')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending_tasks(limit=options['batch_size'])
+            if count:
+                self.stdout.write(f'Ran {count} tasks')
+            if options['once']:
+                return
+            if count < options['batch_size']:
+                time.sleep(options['sleep'])
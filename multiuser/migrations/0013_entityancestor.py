@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_ancestor_links(apps, schema_editor):
+    Entity = apps.get_model('multiuser', 'Entity')
+    EntityAncestor = apps.get_model('multiuser', 'EntityAncestor')
+    parents = dict(Entity.objects.values_list('id', 'parent_id'))
+    links = []
+    for entity_id in parents:
+        ancestor_id, depth = entity_id, 0
+        while ancestor_id is not None:
+            links.append(EntityAncestor(entity_id=entity_id, ancestor_id=ancestor_id, depth=depth))
+            ancestor_id, depth = parents[ancestor_id], depth + 1
+    EntityAncestor.objects.bulk_create(links, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiuser', '0012_rename_inviteduser_invitation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EntityAncestor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('ancestor', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='multiuser.entity')),
+                ('entity', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='multiuser.entity')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ancestor', 'entity'], name='entityancestor_ancestor_idx')],
+                'constraints': [models.UniqueConstraint(fields=('entity', 'ancestor'), name='entityancestor_entity_ancestor_uniq')],
+            },
+        ),
+        migrations.RunPython(build_ancestor_links, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:44
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def link_role_groups(apps, schema_editor):
+    # Match existing groups by the name Entity.get_group_name gives them
+    Group = apps.get_model('auth', 'Group')
+    EntityRoleGroup = apps.get_model('multiuser', 'EntityRoleGroup')
+    group_names = {}
+    for model_name in settings.ENTITY_HIERARCHY:
+        model = apps.get_model('multiuser', model_name)
+        for entity_id, name in model.objects.values_list('entity_ptr_id', 'entity_ptr__name'):
+            for role, role_data in settings.ENTITY_ROLES.items():
+                group_names[f'{name}_{entity_id}_{model_name.lower()}_{role_data["group_name"]}'] = (entity_id, role)
+    groups = Group.objects.filter(name__in=group_names).values_list('name', 'pk')
+    EntityRoleGroup.objects.bulk_create([
+        EntityRoleGroup(entity_id=group_names[name][0], role=group_names[name][1], group_id=group_id) for name, group_id in groups
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('multiuser', '0013_entityancestor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EntityRoleGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('Admin', 'Admin'), ('User', 'User')], max_length=100)),
+                ('entity', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='role_groups', to='multiuser.entity')),
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='entity_role', to='auth.group')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('entity', 'role'), name='entityrolegroup_entity_role_uniq')],
+            },
+        ),
+        migrations.RunPython(link_role_groups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiuser', '0014_entityrolegroup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='entity',
+            index=models.Index(fields=['name', 'id'], name='entity_name_id_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:06
+
+from django.db import migrations, models
+
+
+def build_paths(apps, schema_editor):
+    Entity = apps.get_model('multiuser', 'Entity')
+    parents = dict(Entity.objects.values_list('id', 'parent_id'))
+    entities = []
+    for entity_id in parents:
+        ids, ancestor_id = [], entity_id
+        while ancestor_id is not None:
+            ids.append(ancestor_id)
+            ancestor_id = parents[ancestor_id]
+        entities.append(Entity(id=entity_id, path=''.join(f'/{pk}' for pk in reversed(ids)) + '/'))
+    Entity.objects.bulk_update(entities, ['path'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiuser', '0017_invitation_pending_indexes_archivedinvitation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entity',
+            name='path',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='entity',
+            index=models.Index(fields=['path'], name='entity_path_idx'),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
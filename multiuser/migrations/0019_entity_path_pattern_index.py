@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiuser', '0018_entity_path'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='entity',
+            name='entity_path_idx',
+        ),
+        migrations.AlterField(
+            model_name='entity',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:19
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def delete_duplicate_invitations(apps, schema_editor):
+    # Keep the oldest of each set of pending invitations with the same email, entity and role
+    Invitation = apps.get_model('multiuser', 'Invitation')
+    pending = Invitation.objects.filter(accepted=False)
+    keep = pending.values('email', 'entity', 'role').annotate(keep_id=Min('id')).values('keep_id')
+    pending.exclude(id__in=keep).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multiuser', '0020_task_claimed_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_invitations, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='invitation',
+            constraint=models.UniqueConstraint(condition=models.Q(('accepted', False)), fields=('email', 'entity', 'role'), name='invitation_pending_uniq'),
+        ),
+    ]
@@ -1,12 +1,43 @@
-from django.db import models
-from django.db.models import Q
-from django.apps import apps
+from django.db import models, transaction, connection
+from django.db.models import Q, Exists, OuterRef, Prefetch, Value
+from django.db.models.functions import Concat, Substr
+from django.core.exceptions import ValidationError, PermissionDenied
+from django.core.validators import validate_email
 from django.urls import reverse
+from django.utils import timezone
 from django.conf import settings
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
 from model_utils.managers import InheritanceManager
-from guardian.shortcuts import get_objects_for_user, assign_perm
-from functools import reduce
+from asgiref.sync import sync_to_async
+from guardian.shortcuts import assign_perm
+from guardian.utils import get_anonymous_user, get_group_obj_perms_model
+from . import hierarchy
+from .fragments import invalidate_fragments
+from .etags import invalidate_api_version
+from .permissions import get_grants, get_entity_perms, aget_entity_perms, invalidate_entity_perms
+
+
+class InvitationQuerySet(models.QuerySet):
+    def with_entities(self): # Downcasts the entity of every invitation in the queryset with one extra query
+        return self.prefetch_related(Prefetch('entity', queryset=Entity.objects.select_subclasses()))
+
+    def accept(self, user):
+        # Accepts the pending invitations in the queryset in one transaction: one query for their groups, one insert
+        # for the memberships and one update. Returns the ids of the accepted invitations
+        with transaction.atomic():
+            invitations = self.filter(accepted=False)
+            invitation_ids = list(invitations.select_for_update().values_list('pk', flat=True))
+            if not invitation_ids:
+                return []
+            # A subquery rather than one condition per invitation, which SQLite rejects past about a thousand
+            groups = Group.objects.filter(Exists(invitations.filter(
+                pk__in=invitation_ids, entity_id=OuterRef('entity_role__entity_id'), role=OuterRef('entity_role__role'),
+            )))
+            user.groups.add(*groups.values_list('pk', flat=True))
+            self.model.objects.filter(pk__in=invitation_ids).update(accepted=True)
+        invalidate_api_version()
+        return invitation_ids
 
 
 class Invitation(models.Model):
@@ -16,13 +47,103 @@ class Invitation(models.Model):
     invited_by = models.ForeignKey(User, on_delete=models.CASCADE, editable=False)
     accepted = models.BooleanField(default=False, editable=False)
 
-    def accept(self, user):
-        entity = self.entity.select_subclass() # Downcast
-        group_name = entity.get_group_name(self.role)
-        group = entity.get_group(self.role)
-        user.groups.add(group)
+    objects = InvitationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Partial indexes over the pending invitations only, in the (pk) order the lists page through
+            models.Index(fields=['email', 'id'], condition=Q(accepted=False), name='invitation_pending_email_idx'), # Received list
+            models.Index(fields=['invited_by', 'id'], condition=Q(accepted=False), name='invitation_pending_sender_idx'), # Sent list
+        ]
+        constraints = [
+            # One pending invitation per email, entity and role. Invitation.clean gives forms a friendlier error
+            models.UniqueConstraint(fields=['email', 'entity', 'role'], condition=Q(accepted=False), name='invitation_pending_uniq'),
+        ]
+
+    @classmethod
+    def bulk_invite(cls, invited_by, invitations, batch_size=1000):
+        # invitations are (email, entity id, role) tuples. Checks that invited_by can change every entity in one query,
+        # skips repeated tuples and the ones already pending with another query, and inserts the rest in batches
+        # Returns the created invitations and the skipped tuples
+        rows, errors = [], []
+        for line, (email, entity_id, role) in enumerate(invitations, start=1):
+            email = User.objects.normalize_email(str(email).strip())
+            try:
+                validate_email(email)
+            except ValidationError:
+                errors.append(f'Invitation {line}: invalid email "{email}"')
+            if not isinstance(role, str) or role not in settings.ENTITY_ROLES:
+                errors.append(f'Invitation {line}: invalid role "{role}"')
+            if not str(entity_id).isdigit():
+                errors.append(f'Invitation {line}: invalid entity "{entity_id}"')
+                continue
+            rows.append((email, int(entity_id), role))
+        if errors:
+            raise ValidationError(errors)
+
+        entity_ids = {entity_id for email, entity_id, role in rows}
+        permitted = Entity.get_entities_for_user(invited_by, settings.ENTITY_PERM_CHANGE).filter(pk__in=entity_ids)
+        denied = entity_ids - set(permitted.values_list('pk', flat=True))
+        if denied:
+            raise PermissionDenied(f'You cannot invite users to entities {", ".join(str(pk) for pk in sorted(denied))}')
+
+        # Narrowed down by each column separately, then matched exactly below
+        pending = cls.objects.filter(
+            accepted=False,
+            email__in={email for email, entity_id, role in rows},
+            entity_id__in=entity_ids,
+            role__in={role for email, entity_id, role in rows},
+        )
+        existing = list(pending.values_list('pk', 'email', 'entity_id', 'role'))
+        existing_ids = {pk for pk, *row in existing}
+        seen = {tuple(row) for pk, *row in existing}
+        new, skipped = [], []
+        for row in rows:
+            if row in seen:
+                skipped.append(row)
+            else:
+                seen.add(row)
+                new.append(row)
+
+        # invitation_pending_uniq drops the rows that a concurrent invite inserted in the meantime. Rows skipped that
+        # way come back without ids, so read the created ones back, leaving out the invitations that were pending before
+        with transaction.atomic():
+            cls.objects.bulk_create([
+                cls(email=email, entity_id=entity_id, role=role, invited_by=invited_by) for email, entity_id, role in new
+            ], batch_size=batch_size, ignore_conflicts=True)
+            new_rows = set(new)
+            created = [
+                invitation for invitation in pending.filter(invited_by=invited_by).exclude(pk__in=existing_ids).order_by('pk')
+                if (invitation.email, invitation.entity_id, invitation.role) in new_rows
+            ]
+        invalidate_api_version()
+        created_rows = {(invitation.email, invitation.entity_id, invitation.role) for invitation in created}
+        return created, skipped + [row for row in new if row not in created_rows]
+
+    def accept(self, user): # Only the invitee can accept, and only while the invitation is pending
+        if not Invitation.objects.filter(pk=self.pk, email=user.email).accept(user):
+            raise PermissionDenied('This invitation is not pending for this user')
         self.accepted = True
-        self.save()
+
+    def clean(self):
+        # The bulk equivalent is in bulk_invite
+        if not self.accepted and self.entity_id is not None:
+            pending = Invitation.objects.filter(email=self.email, entity_id=self.entity_id, role=self.role, accepted=False)
+            if pending.exclude(pk=self.pk).exists():
+                raise ValidationError('This user has already been invited to this entity with this role')
+
+    def __str__(self):
+        return self.email
+
+
+class ArchivedInvitation(models.Model):
+    # Accepted invitations moved out of the Invitation table by `manage.py archive_invitations`
+    invitation_id = models.BigIntegerField(unique=True) # Id the invitation had in the Invitation table
+    email = models.EmailField()
+    entity = models.ForeignKey('Entity', on_delete=models.CASCADE, related_name='+')
+    role = models.CharField(max_length=100, choices=[(role, role) for role in settings.ENTITY_ROLES])
+    invited_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    archived_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return self.email
@@ -32,110 +153,371 @@ class Entity(models.Model):
     name = models.CharField(max_length=100)
     created_by = models.ForeignKey(User, on_delete=models.SET_DEFAULT, editable=False, default=1) 
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True)
+    # Materialized path: the ids from the top level entity down to this one, e.g. /12/340/5671/
+    # Written by set_path, move_path and bulk_create_with_groups only, never by a plain save()
+    # On PostgreSQL db_index also adds the varchar_pattern_ops index that prefix matches need
+    path = models.CharField(max_length=255, editable=False, default='', db_index=True)
 
     objects = InheritanceManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['name', 'id'], name='entity_name_id_idx'), # Backs the (name, pk) ordering of the list views
+        ]
+
+    # Hierarchy metadata is precomputed by MultiuserConfig.ready(), see hierarchy.py
+    @classmethod
+    def get_level(cls):
+        return hierarchy.levels[cls]
+
     @classmethod
     def get_rank(cls):
-        return settings.ENTITY_HIERARCHY.index(cls.__name__)
+        return cls.get_level().rank
 
     @classmethod
     def is_top(cls):
-        return cls.get_rank() == 0
+        return cls.get_level().is_top
 
     @classmethod
     def is_bottom(cls):
-        return cls.get_rank() == len(settings.ENTITY_HIERARCHY) - 1
+        return cls.get_level().is_bottom
 
     @classmethod
     def get_top_model(cls):
-        return apps.get_model('multiuser', settings.ENTITY_HIERARCHY[0])
+        return hierarchy.all_models[0]
 
     @classmethod
     def get_bottom_model(cls):
-        return apps.get_model('multiuser', settings.ENTITY_HIERARCHY[-1])
+        return hierarchy.all_models[-1]
 
     @classmethod
     def get_all_models(cls):
-        return [apps.get_model('multiuser', model) for model in settings.ENTITY_HIERARCHY]
+        return list(hierarchy.all_models)
 
     @classmethod
     def get_parent_model(cls): # Returns the model one level up in the hierarchy
-        if cls.is_top():
-            return None
-        return apps.get_model('multiuser', settings.ENTITY_HIERARCHY[cls.get_rank() - 1])
+        return cls.get_level().parent_model
 
     @classmethod
     def get_child_model(cls):
-        if cls.is_bottom():
-            return None
-        return apps.get_model('multiuser', settings.ENTITY_HIERARCHY[cls.get_rank() + 1])
+        return cls.get_level().child_model
 
     # Returns a queryset of objects for which the user has the specified permission for the current model and ancestor models
-    # E.g. queryset.filter(Q(parent__parent__in=grandparent_objects) | Q(parent__in=parent_objects) | Q(pk__in=objects))
+    # Permissions granted on an ancestor are resolved through the EntityAncestor closure table, so the query is a single 
+    # indexed join no matter how deep the hierarchy is
     @classmethod
     def get_objects_for_user(cls, user, perm):
-        model = cls
-        queryset = model.objects.all() # Get all objects of the current model
-        q_objects = [] # Filter for the queryset
-
-        # Filter the list of objects for which the user has the specified permission for the current model
-        model_str = model.__name__.lower()
-        curr = get_objects_for_user(user, f'multiuser.{perm}_{model_str}')
-        q_objects.append(Q(pk__in=curr))
-
-        # Filter the list of objects for which the user has the specified permission for ancestor models
-        q_key = 'in'
-        while not model.is_top(): 
-            model = model.get_parent_model() 
-            model_str = model.__name__.lower()
-            objects = get_objects_for_user(user, f'multiuser.{perm}_{model_str}')
-            q_key = 'parent__' + q_key
-            q_dict = {q_key: objects}
-            q_objects.append(Q(**q_dict))
-
-        conditions = reduce(lambda x, y: x | y, q_objects)
-        return queryset.filter(conditions) 
-
-    @classmethod
-    def get_role(cls, group_name):
-        group_name = group_name.split('_')[-1]
-        for role, role_data in settings.ENTITY_ROLES.items():
-            if role_data['group_name'] == group_name:
-                return role
-        return None
+        queryset = cls.objects.all() # Get all objects of the current model
+        codenames = cls.get_level().get_codenames(perm)
+
+        # Mirror guardian: superusers and users with a global permission see everything
+        if user.is_superuser:
+            return queryset
+        if user.is_anonymous:
+            user = get_anonymous_user()
+        if any(user.has_perm(f'multiuser.{codename}') for codename in codenames):
+            return queryset
+
+        return queryset.filter(pk__in=cls.get_granted_descendants(user, codenames))
+
+    @classmethod
+    async def aget_objects_for_user(cls, user, perm): # Async version of get_objects_for_user
+        queryset = cls.objects.all()
+        codenames = cls.get_level().get_codenames(perm)
+
+        if user.is_superuser:
+            return queryset
+        if user.is_anonymous:
+            user = await sync_to_async(get_anonymous_user)()
+        for codename in codenames:
+            if await user.ahas_perm(f'multiuser.{codename}'):
+                return queryset
+
+        return queryset.filter(pk__in=cls.get_granted_descendants(user, codenames))
+
+    # Returns a queryset of entities at any level of the hierarchy for which the user has the specified permission,
+    # downcast to their subclasses in the same query
+    @classmethod
+    def get_entities_for_user(cls, user, perm):
+        queryset = Entity.objects.select_subclasses()
+        if user.is_superuser:
+            return queryset
+        if user.is_anonymous:
+            user = get_anonymous_user()
+
+        # A global permission on a model covers every object of that model and of the models below it
+        all_models = cls.get_all_models()
+        for rank, model in enumerate(all_models):
+            if user.has_perm(f'multiuser.{perm}_{model._meta.model_name}'):
+                global_q = Q()
+                for lower_model in all_models[rank:]:
+                    global_q |= Q(**{f'{lower_model._meta.model_name}__isnull': False})
+                break
+        else:
+            global_q = Q(pk__in=[])
+
+        codenames = [f'{perm}_{model._meta.model_name}' for model in all_models]
+        return queryset.filter(global_q | Q(pk__in=cls.get_granted_descendants(user, codenames)))
+
+    # Returns the ids of the entities on which the user holds any of the codenames, directly or through one of their 
+    # groups, plus everything below them, as a subquery
+    @classmethod
+    def get_granted_descendants(cls, user, codenames):
+        q_objects = Q()
+        for grants in get_grants(user, codenames):
+            q_objects |= Q(ancestor_id__in=grants.values('object_id'))
+        return EntityAncestor.objects.filter(q_objects).values('entity_id')
+
+    # Whether the user has the specified permission for this object, directly or through an ancestor
+    # Backed by the user's cached effective permissions, so repeated checks in a request cost no queries
+    def user_has_perm(self, user, perm):
+        return get_entity_perms(user).has_perm(self, perm)
+
+    async def auser_has_perm(self, user, perm): # Async version of user_has_perm
+        return (await aget_entity_perms(user)).has_perm(self, perm)
 
     # If you have a foreign key that references the Entity base class, use this method to downcast it when you need to access subclass fields
     def select_subclass(self):
         return Entity.objects.select_subclasses().get(id=self.id)
 
+    # Subtree queries over the materialized path. Compared bytewise, as SQLite does, every path that starts with /12/
+    # sorts between /12/ and /120 (as '0' follows '/'), so a subtree is one range scan of the path index. Other databases
+    # may compare with a collation that ignores the slashes, e.g. en_US.UTF-8 on PostgreSQL, so there the prefix is
+    # matched with LIKE, which PostgreSQL runs against the varchar_pattern_ops index
+    @classmethod
+    def get_path_filter(cls, path):
+        if not path:
+            raise ValueError('Entities only have a path once they are saved')
+        if connection.vendor == 'sqlite':
+            return Q(path__gte=path, path__lt=path[:-1] + '0')
+        return Q(path__startswith=path)
+
+    def get_subtree_filter(self, include_self=True):
+        subtree = self.get_path_filter(self.path)
+        return subtree if include_self else subtree & ~Q(pk=self.pk)
+
+    def get_ancestor_ids(self, include_self=False): # From the top level down, without a query
+        ids = [int(pk) for pk in self.path.strip('/').split('/') if pk]
+        return ids if include_self else ids[:-1]
+
+    # Loads the entity and all of its descendants with one query, downcast, and returns the entity with each node's
+    # children in subtree_children
+    def get_subtree(self):
+        nodes = Entity.objects.select_subclasses().filter(self.get_subtree_filter())
+        nodes_by_id = {}
+        for node in sorted(nodes, key=lambda node: len(node.path)): # A path is longer than the path of its parent
+            node.subtree_children = []
+            nodes_by_id[node.pk] = node
+            if node.pk != self.pk:
+                nodes_by_id[node.parent_id].subtree_children.append(node)
+        for node in nodes_by_id.values():
+            node.subtree_children.sort(key=lambda child: (child.name, child.pk))
+        return nodes_by_id[self.pk]
+
     def get_group_name(self, role):
         return f'{self.name}_{self.pk}_{self._meta.model_name}_{settings.ENTITY_ROLES[role]["group_name"]}'
 
+    # Groups are found through the EntityRoleGroup mapping, so their names are only for display
     def get_group(self, role):
-        group_name = self.get_group_name(role)
-        return Group.objects.filter(name=group_name).first()
+        return Group.objects.filter(entity_role__entity=self, entity_role__role=role).first()
 
     def create_groups(self):
         for role in settings.ENTITY_ROLES:
-            group_name = self.get_group_name(role)
-            group, created = Group.objects.get_or_create(name=group_name)
+            group = self.get_group(role)
+            if group is None:
+                group = Group.objects.create(name=self.get_group_name(role))
+                EntityRoleGroup.objects.create(entity=self, role=role, group=group)
             for permission in settings.ENTITY_ROLES[role]['permissions']:
                 assign_perm(f'{permission}_{self._meta.model_name}', group, self)
+        invalidate_entity_perms()
 
-    def delete_groups(self):
+    def rename_groups(self):
+        # Keep the display names of the existing groups in step with the entity name
         for role in settings.ENTITY_ROLES:
-            group_name = self.get_group_name(role)
-            group = Group.objects.filter(name=group_name).first()
-            if group is not None:
-                group.delete()
+            Group.objects.filter(entity_role__entity=self, entity_role__role=role).update(name=self.get_group_name(role))
+
+    # Creates entities of the current model along with their ancestor links, role groups, group permissions and the 
+    # creator's admin membership, using a fixed number of queries per batch rather than several per entity
+    # Like bulk_create, save() is not called and no signals are sent
+    @classmethod
+    def bulk_create_with_groups(cls, objs, batch_size=1000):
+        objs = list(objs)
+        cls.validate_parents(objs)
+        with transaction.atomic():
+            for start in range(0, len(objs), batch_size):
+                cls.bulk_create_batch(objs[start:start + batch_size])
+        invalidate_entity_perms()
+        invalidate_fragments({obj.parent_id for obj in objs})
+        return objs
+
+    @classmethod
+    def validate_parents(cls, objs): # Same rules as clean(), checked for all objects in one query
+        parent_field = Entity._meta.get_field('parent')
+        for obj in objs: # Ids read from a CSV file or a task payload may still be strings
+            obj.parent_id = parent_field.to_python(obj.parent_id)
+        parent_ids = {obj.parent_id for obj in objs}
+        if cls.is_top():
+            if parent_ids - {None}:
+                raise ValidationError('Top level entities cannot have parents')
+            return
+        if None in parent_ids:
+            raise ValidationError('Non top level entities must have parents')
+        if cls.get_parent_model().objects.filter(pk__in=parent_ids).count() != len(parent_ids):
+            raise ValidationError('Parent must be of the correct type')
+
+    @classmethod
+    def bulk_create_batch(cls, objs):
+        # Base table rows first, since Django's bulk_create refuses multi-table inherited models
+        entities = Entity.objects.bulk_create([
+            Entity(name=obj.name, created_by_id=obj.created_by_id, parent_id=obj.parent_id) for obj in objs
+        ])
+        parent_paths = dict(Entity.objects.filter(pk__in={obj.parent_id for obj in objs}).values_list('pk', 'path'))
+        for obj, entity in zip(objs, entities):
+            obj.id = obj.pk = entity.pk
+            obj._state.adding = False
+            obj.path = entity.path = f'{parent_paths.get(obj.parent_id, "/")}{entity.pk}/'
+        Entity.objects.bulk_update(entities, ['path'])
+
+        # Then the subclass table rows
+        fields = cls._meta.local_concrete_fields
+        table = connection.ops.quote_name(cls._meta.db_table)
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        placeholders = ', '.join(['%s'] * len(fields))
+        rows = [[field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields] for obj in objs]
+        with connection.cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', rows)
+
+        # Ancestor links: each entity itself plus every ancestor of its parent
+        parent_links = {}
+        for entity_id, ancestor_id, depth in EntityAncestor.objects.filter(entity_id__in={obj.parent_id for obj in objs}).values_list('entity_id', 'ancestor_id', 'depth'):
+            parent_links.setdefault(entity_id, []).append((ancestor_id, depth))
+        links = []
+        for obj in objs:
+            links.append(EntityAncestor(entity_id=obj.pk, ancestor_id=obj.pk, depth=0))
+            links += [EntityAncestor(entity_id=obj.pk, ancestor_id=ancestor_id, depth=depth + 1) for ancestor_id, depth in parent_links.get(obj.parent_id, [])]
+        EntityAncestor.objects.bulk_create(links)
+
+        # One group per role per entity, with the role's object permissions
+        groups = Group.objects.bulk_create([Group(name=obj.get_group_name(role)) for obj in objs for role in settings.ENTITY_ROLES])
+        groups = iter(groups)
+        content_type = ContentType.objects.get_for_model(cls)
+        permissions = {permission.codename: permission for permission in Permission.objects.filter(content_type=content_type)}
+        GroupObjectPermission = get_group_obj_perms_model()
+        role_groups, group_perms, memberships = [], [], []
+        for obj in objs:
+            for role in settings.ENTITY_ROLES:
+                group = next(groups)
+                role_groups.append(EntityRoleGroup(entity_id=obj.pk, role=role, group=group))
+                for permission in settings.ENTITY_ROLES[role]['permissions']:
+                    permission = permissions[f'{permission}_{cls._meta.model_name}']
+                    group_perms.append(GroupObjectPermission(group=group, permission=permission, content_type=content_type, object_pk=str(obj.pk)))
+                if role == settings.ENTITY_ROLE_ADMIN: # Add the user who created the entity instance to its admin group
+                    memberships.append(User.groups.through(user_id=obj.created_by_id, group_id=group.pk))
+        EntityRoleGroup.objects.bulk_create(role_groups)
+        GroupObjectPermission.objects.bulk_create(group_perms)
+        User.groups.through.objects.bulk_create(memberships)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the values as loaded so save() can tell what has changed
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def get_loaded_value(self, attname): # Returns the value of the field as it is currently stored in the database
+        value = getattr(self, '_loaded_values', {}).get(attname, models.DEFERRED)
+        if value is models.DEFERRED:
+            value = Entity.objects.filter(pk=self.pk).values_list(attname, flat=True).first()
+        return value
+
+    def create_ancestor_links(self):
+        # Link the entity to itself and to every ancestor of its parent
+        links = [EntityAncestor(entity_id=self.pk, ancestor_id=self.pk, depth=0)]
+        if self.parent_id is not None:
+            parent_links = EntityAncestor.objects.filter(entity_id=self.parent_id).values_list('ancestor_id', 'depth')
+            links += [EntityAncestor(entity_id=self.pk, ancestor_id=ancestor_id, depth=depth + 1) for ancestor_id, depth in parent_links]
+        EntityAncestor.objects.bulk_create(links)
+
+    def set_path(self):
+        parent_path = Entity.objects.filter(pk=self.parent_id).values_list('path', flat=True).first() or '/'
+        self.path = f'{parent_path}{self.pk}/'
+        Entity.objects.filter(pk=self.pk).update(path=self.path)
+
+    def move_path(self):
+        # Swap the old path prefix of the entity and its descendants for the one below the new parent, in one UPDATE
+        old_path = Entity.objects.filter(pk=self.pk).values_list('path', flat=True).get()
+        parent_path = Entity.objects.filter(pk=self.parent_id).values_list('path', flat=True).first() or '/'
+        self.path = f'{parent_path}{self.pk}/'
+        subtree = Entity.objects.filter(self.get_path_filter(old_path))
+        subtree.update(path=Concat(Value(self.path), Substr('path', len(old_path) + 1)))
+
+    def move_ancestor_links(self):
+        # Detach the subtree rooted at the entity from its old ancestors, then attach it below the new parent
+        # One DELETE and one INSERT ... SELECT, whatever the size of the subtree
+        subtree_ids = EntityAncestor.objects.filter(ancestor_id=self.pk).values('entity_id')
+        old_ancestor_ids = EntityAncestor.objects.filter(entity_id=self.pk, depth__gt=0).values('ancestor_id')
+        EntityAncestor.objects.filter(entity_id__in=subtree_ids, ancestor_id__in=old_ancestor_ids).delete()
+        if self.parent_id is not None:
+            table = connection.ops.quote_name(EntityAncestor._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {table} (entity_id, ancestor_id, depth) '
+                    f'SELECT subtree.entity_id, parent.ancestor_id, parent.depth + subtree.depth + 1 '
+                    f'FROM {table} subtree, {table} parent WHERE subtree.ancestor_id = %s AND parent.entity_id = %s',
+                    [self.pk, self.parent_id],
+                )
+
+    def move_to(self, parent):
+        # Reparents the entity and updates the ancestor links and paths of its whole subtree in a fixed number of
+        # statements, in one transaction. Unlike save() nothing else is written, and the groups stay as they are
+        old_parent_id = self.get_loaded_value('parent_id') # The instance may already hold the new parent, e.g. from a form
+        self.parent = parent
+        try:
+            self.clean()
+        except ValidationError:
+            self.parent_id = old_parent_id
+            raise
+        if self.parent_id == old_parent_id:
+            return
+        with transaction.atomic():
+            Entity.objects.filter(pk=self.pk).update(parent=parent)
+            self.move_ancestor_links()
+            self.move_path()
+        self._loaded_values = {**getattr(self, '_loaded_values', {}), 'parent_id': self.parent_id}
+        invalidate_entity_perms()
+        invalidate_fragments([self.pk, self.parent_id, old_parent_id])
 
     def save(self, *args, **kwargs):
+        adding = self._state.adding
+        old_name = None if adding else self.get_loaded_value('name')
+        old_parent_id = None if adding else self.get_loaded_value('parent_id')
+        reparented = not adding and self.parent_id != old_parent_id
+        if not adding and kwargs.get('update_fields') is None:
+            # Leave path alone, so that a copy loaded before one of its ancestors moved can't overwrite the new path
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != 'path']
         super().save(*args, **kwargs)
-        # Create the admin group and other groups for this entity instance
-        self.create_groups()
-        # Add the user who created the entity instance to its admin group
-        self.created_by.groups.add(self.get_group(settings.ENTITY_ROLE_ADMIN))
+        self._loaded_values = {**getattr(self, '_loaded_values', {}), 'name': self.name, 'parent_id': self.parent_id}
+        # The entity's own page fragments and the children lists of its old and new parent
+        invalidate_fragments([self.pk, self.parent_id, old_parent_id])
+
+        if adding:
+            self.create_ancestor_links()
+            self.set_path()
+            # Create the admin group and other groups for this entity instance
+            self.create_groups()
+            # Add the user who created the entity instance to its admin group
+            self.created_by.groups.add(self.get_group(settings.ENTITY_ROLE_ADMIN))
+            return
+
+        # Updates only touch the groups when the name they embed has changed
+        if self.name != old_name:
+            self.rename_groups()
+        # Keep the closure table and paths in step with the parent field
+        if reparented:
+            with transaction.atomic():
+                self.move_ancestor_links()
+                self.move_path()
+            invalidate_entity_perms()
 
     def clean(self):
         if self.is_top() and self.parent is not None:
@@ -149,6 +531,65 @@ class Entity(models.Model):
         return self.name
 
 
+class EntityAncestor(models.Model):
+    # Closure table of the entity hierarchy: one row per (entity, ancestor) pair, including the entity itself at depth 0
+    entity = models.ForeignKey(Entity, on_delete=models.CASCADE, related_name='ancestor_links', db_index=False)
+    ancestor = models.ForeignKey(Entity, on_delete=models.CASCADE, related_name='descendant_links', db_index=False)
+    depth = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['entity', 'ancestor'], name='entityancestor_entity_ancestor_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['ancestor', 'entity'], name='entityancestor_ancestor_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.entity_id} -> {self.ancestor_id} ({self.depth})'
+
+
+class EntityRoleGroup(models.Model):
+    # The group that holds each role of each entity
+    entity = models.ForeignKey(Entity, on_delete=models.CASCADE, related_name='role_groups', db_index=False)
+    role = models.CharField(max_length=100, choices=[(role, role) for role in settings.ENTITY_ROLES])
+    group = models.OneToOneField(Group, on_delete=models.CASCADE, related_name='entity_role')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['entity', 'role'], name='entityrolegroup_entity_role_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.entity_id} {self.role}'
+
+
+class Task(models.Model):
+    # Background task queued by tasks.DatabaseBackend and run by `manage.py run_tasks`
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, default=PENDING, choices=[(status, status) for status in [PENDING, RUNNING, DONE, FAILED]])
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True, blank=True) # When a worker last started running the task
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='task_status_run_after_idx'), # Backs the worker's due task query
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.status})'
+
+
 class Organisation(Entity):
     organisation_fields = models.CharField(max_length=100)
 
@@ -0,0 +1,168 @@
+from collections import defaultdict
+from uuid import uuid4
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, BigIntegerField
+from django.db.models.functions import Cast
+from asgiref.sync import sync_to_async
+from guardian.utils import get_anonymous_user, get_user_obj_perms_model, get_group_obj_perms_model
+from .instrumentation import timed, count
+from .etags import invalidate_api_version
+
+VERSION_KEY = 'multiuser:entity_perms:version'
+USER_VERSION_KEY = 'multiuser:entity_perms:version:{user_pk}'
+PERMS_KEY = 'multiuser:entity_perms:{user_pk}:{version}:{user_version}'
+MEMO_ATTR = '_entity_perms_cache' # Per-request memo, stored on the user object like Django's own _perm_cache
+
+
+class EntityPerms:
+    # A user's effective permissions: the codenames they hold globally, plus for every entity id
+    # the permissions (view/change/delete) they hold on it directly or through an ancestor
+    def __init__(self, is_superuser=False, global_codenames=(), entity_perms=None):
+        self.is_superuser = is_superuser
+        self.global_codenames = frozenset(global_codenames)
+        self.entity_perms = entity_perms or {}
+
+    def has_perm(self, entity, perm): # The entity must be downcast so that its model is known
+        if self.is_superuser:
+            return True
+        if any(codename in self.global_codenames for codename in entity.get_level().get_codenames(perm)):
+            return True
+        return perm in self.entity_perms.get(entity.pk, ())
+
+
+def get_grants(user, codenames=None):
+    # Returns the (entity id, codename) pairs for the object permissions the user holds directly or through their groups
+    perm_filter = Q(permission__content_type__app_label='multiuser')
+    if codenames is not None:
+        perm_filter &= Q(permission__codename__in=codenames)
+    user_grants = get_user_obj_perms_model().objects.filter(perm_filter, user=user)
+    group_grants = get_group_obj_perms_model().objects.filter(perm_filter, group__user=user)
+    return [
+        grants.annotate(object_id=Cast('object_pk', BigIntegerField())).values_list('object_id', 'permission__codename')
+        for grants in (user_grants, group_grants)
+    ]
+
+
+@timed('perms')
+def compute_entity_perms(user):
+    if user.is_superuser:
+        return EntityPerms(is_superuser=True)
+    if user.is_anonymous:
+        user = get_anonymous_user()
+    global_codenames = [perm.split('.', 1)[1] for perm in user.get_all_permissions() if perm.startswith('multiuser.')]
+
+    perms_by_ancestor = defaultdict(set)
+    q_objects = Q()
+    for grants in get_grants(user):
+        for object_id, codename in grants:
+            perms_by_ancestor[object_id].add(codename.split('_', 1)[0])
+        q_objects |= Q(ancestor_id__in=grants.values('object_id'))
+
+    # Hand each grant down to the entity itself and everything below it
+    entity_perms = defaultdict(set)
+    if perms_by_ancestor:
+        EntityAncestor = apps.get_model('multiuser', 'EntityAncestor')
+        for ancestor_id, entity_id in EntityAncestor.objects.filter(q_objects).values_list('ancestor_id', 'entity_id'):
+            entity_perms[entity_id] |= perms_by_ancestor[ancestor_id]
+    return EntityPerms(global_codenames=global_codenames, entity_perms=dict(entity_perms))
+
+
+@timed('perms')
+async def acompute_entity_perms(user): # Async version of compute_entity_perms
+    if user.is_superuser:
+        return EntityPerms(is_superuser=True)
+    if user.is_anonymous:
+        user = await sync_to_async(get_anonymous_user)()
+    global_codenames = [perm.split('.', 1)[1] for perm in await user.aget_all_permissions() if perm.startswith('multiuser.')]
+
+    perms_by_ancestor = defaultdict(set)
+    q_objects = Q()
+    for grants in get_grants(user):
+        async for object_id, codename in grants:
+            perms_by_ancestor[object_id].add(codename.split('_', 1)[0])
+        q_objects |= Q(ancestor_id__in=grants.values('object_id'))
+
+    entity_perms = defaultdict(set)
+    if perms_by_ancestor:
+        EntityAncestor = apps.get_model('multiuser', 'EntityAncestor')
+        async for ancestor_id, entity_id in EntityAncestor.objects.filter(q_objects).values_list('ancestor_id', 'entity_id'):
+            entity_perms[entity_id] |= perms_by_ancestor[ancestor_id]
+    return EntityPerms(global_codenames=global_codenames, entity_perms=dict(entity_perms))
+
+
+def get_cache_key(user):
+    user_version_key = USER_VERSION_KEY.format(user_pk=user.pk)
+    versions = cache.get_many([VERSION_KEY, user_version_key])
+    return PERMS_KEY.format(user_pk=user.pk, version=versions.get(VERSION_KEY, 0), user_version=versions.get(user_version_key, 0))
+
+
+def get_entity_perms(user):
+    # Computed once per request, and kept in the cache framework across requests when ENTITY_PERMS_CACHE_TIMEOUT is set
+    perms = getattr(user, MEMO_ATTR, None)
+    if perms is not None:
+        count('perms_memo_hit')
+        return perms
+
+    timeout = settings.ENTITY_PERMS_CACHE_TIMEOUT
+    if timeout and user.is_authenticated:
+        key = get_cache_key(user)
+        perms = cache.get(key)
+        if perms is None:
+            count('perms_cache_miss')
+            perms = compute_entity_perms(user)
+            cache.set(key, perms, timeout)
+        else:
+            count('perms_cache_hit')
+    else:
+        count('perms_cache_miss')
+        perms = compute_entity_perms(user)
+
+    setattr(user, MEMO_ATTR, perms)
+    return perms
+
+
+async def aget_cache_key(user):
+    user_version_key = USER_VERSION_KEY.format(user_pk=user.pk)
+    versions = await cache.aget_many([VERSION_KEY, user_version_key])
+    return PERMS_KEY.format(user_pk=user.pk, version=versions.get(VERSION_KEY, 0), user_version=versions.get(user_version_key, 0))
+
+
+async def aget_entity_perms(user): # Async version of get_entity_perms
+    perms = getattr(user, MEMO_ATTR, None)
+    if perms is not None:
+        count('perms_memo_hit')
+        return perms
+
+    timeout = settings.ENTITY_PERMS_CACHE_TIMEOUT
+    if timeout and user.is_authenticated:
+        key = await aget_cache_key(user)
+        perms = await cache.aget(key)
+        if perms is None:
+            count('perms_cache_miss')
+            perms = await acompute_entity_perms(user)
+            await cache.aset(key, perms, timeout)
+        else:
+            count('perms_cache_hit')
+    else:
+        count('perms_cache_miss')
+        perms = await acompute_entity_perms(user)
+
+    setattr(user, MEMO_ATTR, perms)
+    return perms
+
+
+def invalidate_entity_perms(users=None):
+    # Pass the users (or user ids) whose permissions changed, or nothing to invalidate every user
+    invalidate_api_version()
+    for user in users or ():
+        if hasattr(user, MEMO_ATTR):
+            delattr(user, MEMO_ATTR)
+    if not settings.ENTITY_PERMS_CACHE_TIMEOUT:
+        return
+    if users is None:
+        cache.set(VERSION_KEY, uuid4().hex, None)
+    else:
+        user_pks = [getattr(user, 'pk', user) for user in users]
+        cache.set_many({USER_VERSION_KEY.format(user_pk=user_pk): uuid4().hex for user_pk in user_pks}, None)
@@ -1,18 +1,100 @@
-from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.db.backends.signals import connection_created
 from django.dispatch import receiver
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import User, Group
 from django.conf import settings
 from guardian.shortcuts import assign_perm
+from guardian.utils import get_user_obj_perms_model, get_group_obj_perms_model
 from .models import *
+from .permissions import invalidate_entity_perms
+from .fragments import invalidate_fragments
+from .etags import invalidate_api_version
+from . import tasks
 
-@receiver(post_delete, sender=Organisation)
+# The groups are looked up before the entity is deleted, while its EntityRoleGroup rows still lead to them,
+# and deleted by a background task
+def queue_group_cleanup(entity):
+    group_ids = list(Group.objects.filter(entity_role__entity=entity).values_list('pk', flat=True))
+    if group_ids:
+        tasks.delete_groups.delay(group_ids)
+    invalidate_entity_perms()
+    invalidate_fragments([entity.pk, entity.parent_id])
+
+@receiver(pre_delete, sender=Organisation)
 def delete_organisation_groups(sender, instance, **kwargs):
-    instance.delete_groups()
+    queue_group_cleanup(instance)
 
-@receiver(post_delete, sender=Business)
+@receiver(pre_delete, sender=Business)
 def delete_business_groups(sender, instance, **kwargs):
-    instance.delete_groups()
+    queue_group_cleanup(instance)
 
-@receiver(post_delete, sender=Branch)
+@receiver(pre_delete, sender=Branch)
 def delete_branch_groups(sender, instance, **kwargs):
-    instance.delete_groups()
+    queue_group_cleanup(instance)
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_member_perms(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse: # user.groups changed
+        invalidate_entity_perms([instance])
+    elif pk_set is not None: # group.user_set changed
+        invalidate_entity_perms(pk_set)
+    else: # group.user_set was cleared, so the affected users are no longer known
+        invalidate_entity_perms()
+
+    # The users panels of the entities whose groups changed, and of the entities below them
+    if not reverse and pk_set is None: # user.groups was cleared, so the groups are no longer known
+        invalidate_fragments()
+    else:
+        group_ids = [instance.pk] if reverse else pk_set
+        invalidate_fragments(EntityRoleGroup.objects.filter(group_id__in=group_ids).values_list('entity_id', flat=True))
+
+# Object and global permissions granted or revoked outside create_groups, e.g. with assign_perm/remove_perm or
+# through the admin. Like other bulk operations, bulk_create and queryset.update() send no signals
+@receiver([post_save, post_delete], sender=get_user_obj_perms_model())
+def invalidate_user_object_perms(sender, instance, **kwargs):
+    invalidate_entity_perms([instance.user_id])
+
+@receiver([post_save, post_delete], sender=get_group_obj_perms_model())
+def invalidate_group_object_perms(sender, instance, **kwargs):
+    invalidate_entity_perms() # Every member of the group, without looking them up
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_user_global_perms(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse: # user.user_permissions changed
+        invalidate_entity_perms([instance])
+    elif pk_set is not None: # permission.user_set changed
+        invalidate_entity_perms(pk_set)
+    else:
+        invalidate_entity_perms()
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_group_global_perms(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_entity_perms()
+
+@receiver(post_save, sender=Invitation)
+def invalidate_saved_invitation_api(sender, instance, **kwargs):
+    invalidate_api_version()
+
+@receiver(post_delete, sender=Invitation)
+def invalidate_deleted_invitation_api(sender, instance, **kwargs):
+    if not instance.accepted: # The API only lists pending invitations, so archiving accepted ones changes nothing
+        invalidate_api_version()
+
+@receiver(post_save, sender=User)
+def invalidate_user_fragments(sender, instance, created, update_fields, **kwargs):
+    # The users panels show usernames and emails, and is_superuser changes every permission. Logins only update last_login
+    if not created and update_fields != frozenset(['last_login']):
+        invalidate_entity_perms([instance])
+        invalidate_fragments()
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and settings.SQLITE_PRAGMAS:
+        with connection.cursor() as cursor:
+            for pragma, value in settings.SQLITE_PRAGMAS.items():
+                cursor.execute(f'PRAGMA {pragma} = {value}')
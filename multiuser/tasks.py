@@ -0,0 +1,164 @@
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.mail import send_mass_mail
+from django.db import transaction, close_old_connections
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Background tasks. Decorate a function with @task and call func.delay(*args, **kwargs) to run it through the backend
+# named by settings.TASK_BACKEND. Arguments must be JSON serializable so the database backend can store them
+
+registry = {} # Task name -> function
+
+
+def task(func):
+    name = f'{func.__module__}.{func.__name__}'
+    registry[name] = func
+    func.task_name = name
+    func.delay = lambda *args, **kwargs: get_backend().enqueue(name, list(args), kwargs)
+    return func
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    return import_string(settings.TASK_BACKEND)()
+
+
+def get_retry_delay(attempts): # Seconds to wait after the given number of failed attempts
+    return settings.TASK_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+class ImmediateBackend:
+    # Runs the task in the calling thread once the current transaction commits. Errors propagate, which suits tests
+    def enqueue(self, name, args, kwargs):
+        transaction.on_commit(lambda: registry[name](*args, **kwargs))
+
+
+class ThreadPoolBackend:
+    # Runs the task in a thread pool inside the web process once the current transaction commits
+    # Tasks still waiting are lost if the process exits, so use DatabaseBackend for work that must not be dropped
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=settings.TASK_THREADS, thread_name_prefix='multiuser-task')
+
+    def enqueue(self, name, args, kwargs):
+        transaction.on_commit(lambda: self.executor.submit(self.run, name, args, kwargs))
+
+    def run(self, name, args, kwargs):
+        for attempt in range(1, settings.TASK_MAX_ATTEMPTS + 1):
+            close_old_connections()
+            try:
+                registry[name](*args, **kwargs)
+                return
+            except Exception:
+                logger.exception('Task %s failed (attempt %s of %s)', name, attempt, settings.TASK_MAX_ATTEMPTS)
+                if attempt < settings.TASK_MAX_ATTEMPTS:
+                    time.sleep(get_retry_delay(attempt))
+            finally:
+                close_old_connections()
+
+
+class DatabaseBackend:
+    # Stores the task in the Task table, in the same transaction as the data it refers to, for `manage.py run_tasks`
+    def enqueue(self, name, args, kwargs):
+        Task = apps.get_model('multiuser', 'Task')
+        Task.objects.create(name=name, args=args, kwargs=kwargs)
+
+
+def requeue_stale_tasks():
+    # A task claimed more than TASK_LEASE_TIMEOUT seconds ago whose worker died stays RUNNING, so count that run as a
+    # failed attempt. Returns how many tasks were requeued or failed
+    Task = apps.get_model('multiuser', 'Task')
+    now = timezone.now()
+    stale = Task.objects.filter(status=Task.RUNNING, claimed_at__lt=now - timedelta(seconds=settings.TASK_LEASE_TIMEOUT))
+    error = f'Still running after {settings.TASK_LEASE_TIMEOUT} seconds, the worker is taken to have died'
+    failed = stale.filter(attempts__gte=settings.TASK_MAX_ATTEMPTS).update(status=Task.FAILED, last_error=error)
+    requeued = stale.update(status=Task.PENDING, run_after=now, last_error=error)
+    if failed or requeued:
+        logger.warning('Requeued %s and failed %s tasks whose worker died', requeued, failed)
+    return failed + requeued
+
+
+def run_pending_tasks(limit=100):
+    # Runs up to limit due tasks from the Task table and returns how many were run
+    # TASK_LEASE_TIMEOUT must be longer than the slowest task, or a task still running is run again
+    Task = apps.get_model('multiuser', 'Task')
+    requeue_stale_tasks()
+    due = Task.objects.filter(status=Task.PENDING, run_after__lte=timezone.now()).order_by('run_after', 'pk')
+    count = 0
+    for pending in due[:limit]:
+        # Claim the task with a conditional update so that concurrent workers never run it twice
+        claimed = Task.objects.filter(pk=pending.pk, status=Task.PENDING).update(
+            status=Task.RUNNING, attempts=pending.attempts + 1, claimed_at=timezone.now(),
+        )
+        if not claimed:
+            continue
+        pending.attempts += 1
+        count += 1
+        try:
+            registry[pending.name](*pending.args, **pending.kwargs)
+        except Exception:
+            logger.exception('Task %s failed (attempt %s of %s)', pending.name, pending.attempts, settings.TASK_MAX_ATTEMPTS)
+            failed = pending.attempts >= settings.TASK_MAX_ATTEMPTS
+            Task.objects.filter(pk=pending.pk).update(
+                status=Task.FAILED if failed else Task.PENDING,
+                run_after=timezone.now() + timedelta(seconds=get_retry_delay(pending.attempts)),
+                last_error=traceback.format_exc(),
+            )
+        else:
+            Task.objects.filter(pk=pending.pk).update(status=Task.DONE, last_error='')
+    return count
+
+
+@task
+def send_invitation_email(invitation_id):
+    send_invitation_emails([invitation_id])
+
+
+@task
+def send_invitation_emails(invitation_ids):
+    # Invitations cancelled before they could be sent are no longer found
+    Invitation = apps.get_model('multiuser', 'Invitation')
+    invitations = Invitation.objects.filter(pk__in=invitation_ids).select_related('invited_by').with_entities()
+    send_mass_mail([
+        (
+            f'You have been invited to {invitation.entity}',
+            f'{invitation.invited_by} has invited you to be a/an {invitation.role} for {invitation.entity} '
+            f'({invitation.entity._meta.verbose_name}). Sign in and open {reverse("invitationreceived_list")} to accept.',
+            None,
+            [invitation.email],
+        )
+        for invitation in invitations
+    ])
+
+
+@task
+def record_invitation_accepted(invitation_id, user_id):
+    record_invitations_accepted([invitation_id], user_id)
+
+
+@task
+def record_invitations_accepted(invitation_ids, user_id):
+    for invitation_id in invitation_ids:
+        logger.info('Invitation %s accepted by user %s', invitation_id, user_id)
+
+
+@task
+def provision_entities(model_name, rows, created_by_id, batch_size=1000):
+    # rows are dicts of field values, e.g. {'name': ..., 'parent_id': ..., 'branch_fields': ...}
+    model = apps.get_model('multiuser', model_name)
+    model.bulk_create_with_groups([model(created_by_id=created_by_id, **row) for row in rows], batch_size=batch_size)
+
+
+@task
+def delete_groups(group_ids):
+    Group.objects.filter(pk__in=group_ids).delete()
@@ -1,3 +1,929 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import User, Group, Permission
+from django.db import connection, DatabaseError, IntegrityError, transaction
+from django.db.models import Q
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from guardian.core import ObjectPermissionChecker
+from guardian.shortcuts import assign_perm, remove_perm
+from .models import ArchivedInvitation, Entity, EntityAncestor, EntityRoleGroup, Invitation, Task, Organisation, Business, Branch
+from .benchmark import build_hierarchy, get_benchmark_urls, measure
+from .permissions import get_entity_perms
+from .fragments import aget_fragment
+from .tasks import run_pending_tasks, record_invitations_accepted
 
-# Create your tests here.
+
+class ViewQueryCountTests(TestCase):
+    # The number of queries of each view must not grow with the number of entities, memberships or invitations
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.members = build_hierarchy([2, 2, 2], users=4, seed=0)
+
+    def get_query_counts(self, user):
+        self.client.force_login(user)
+        return {name: measure(self.client, url, repeat=1)['queries'] for name, url in get_benchmark_urls(user)}
+
+    def assertConstantQueries(self, user):
+        before = self.get_query_counts(user)
+        build_hierarchy([3, 3, 3], users=8, seed=1)
+        after = self.get_query_counts(user)
+        self.assertEqual(after, before)
+
+    def test_owner(self):
+        self.assertConstantQueries(self.owner)
+
+    def test_member(self):
+        member = self.members.filter(groups__isnull=False).first()
+        self.assertConstantQueries(member)
+
+    def test_all_views_measured(self):
+        names = [name for name, url in get_benchmark_urls(self.owner)]
+        self.assertEqual(names, [
+            'organisation_list', 'organisation_detail', 'business_list', 'business_detail', 'branch_list', 'branch_detail',
+            'invitation_create', 'invitationsent_list', 'invitationreceived_list',
+        ])
+
+
+class EntityMoveTests(TestCase):
+    # Moving an entity rewrites the ancestry of its whole subtree in the same number of statements whatever its size
+
+    @classmethod
+    def setUpTestData(cls):
+        build_hierarchy([2, 2, 3], users=0, seed=0)
+
+    def assertAncestryConsistent(self):
+        for entity in Entity.objects.select_related('parent'):
+            ancestors = []
+            ancestor = entity
+            while ancestor is not None:
+                ancestors.append(ancestor)
+                ancestor = ancestor.parent
+            links = EntityAncestor.objects.filter(entity_id=entity.pk).values_list('ancestor_id', 'depth')
+            self.assertEqual(sorted(links), sorted((ancestor.pk, depth) for depth, ancestor in enumerate(ancestors)))
+            self.assertEqual(entity.path, '/' + ''.join(f'{ancestor.pk}/' for ancestor in reversed(ancestors)))
+
+    def test_move(self):
+        business = Business.objects.order_by('pk').first()
+        organisation = Organisation.objects.exclude(pk=business.parent_id).first()
+        with self.assertNumQueries(8):
+            business.move_to(organisation)
+        self.assertEqual(Business.objects.get(pk=business.pk).parent_id, organisation.pk)
+        self.assertAncestryConsistent()
+
+    def test_subtree_filter(self):
+        # The bytewise range used on SQLite and the prefix match used elsewhere select the same closure table subtree
+        organisation = Organisation.objects.order_by('pk').first()
+        expected = set(EntityAncestor.objects.filter(ancestor=organisation).values_list('entity_id', flat=True))
+        self.assertEqual(set(Entity.objects.filter(organisation.get_subtree_filter()).values_list('pk', flat=True)), expected)
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            self.assertEqual(set(Entity.objects.filter(organisation.get_subtree_filter()).values_list('pk', flat=True)), expected)
+            self.assertNotIn(organisation.pk, Entity.objects.filter(organisation.get_subtree_filter(include_self=False)).values_list('pk', flat=True))
+
+    def test_subtree_filter_unsaved(self):
+        with self.assertRaises(ValueError):
+            Organisation(name='Unsaved').get_subtree_filter()
+
+    def test_move_to_wrong_level(self):
+        branch = Branch.objects.order_by('pk').first()
+        parent_id = branch.parent_id
+        with self.assertRaises(ValidationError):
+            branch.move_to(Organisation.objects.first())
+        self.assertEqual(branch.parent_id, parent_id)
+        self.assertAncestryConsistent()
+
+
+class InvitationAcceptTests(TestCase):
+    # Only the invitee can accept or reject an invitation, and only its sender can cancel it
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.invitee = User.objects.create_user('invitee', 'invitee@example.com')
+        cls.stranger = User.objects.create_user('stranger', 'stranger@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+        cls.admin_group = cls.organisation.get_group(settings.ENTITY_ROLE_ADMIN)
+
+    def setUp(self):
+        self.invitation = Invitation.objects.create(
+            email=self.invitee.email, entity=self.organisation, role=settings.ENTITY_ROLE_ADMIN, invited_by=self.owner,
+        )
+
+    def assertAccepted(self, user, accepted):
+        self.invitation.refresh_from_db()
+        self.assertEqual(self.invitation.accepted, accepted)
+        self.assertEqual(user.groups.filter(pk=self.admin_group.pk).exists(), accepted)
+
+    def test_accept(self):
+        self.client.force_login(self.invitee)
+        response = self.client.post(reverse('invitation_accept', kwargs={'pk': self.invitation.pk}))
+        self.assertRedirects(response, reverse('invitationreceived_list'))
+        self.assertAccepted(self.invitee, True)
+
+    def test_accept_someone_elses(self):
+        self.client.force_login(self.stranger)
+        response = self.client.post(reverse('invitation_accept', kwargs={'pk': self.invitation.pk}))
+        self.assertEqual(response.status_code, 404)
+        self.assertAccepted(self.stranger, False)
+
+    def test_accept_twice(self):
+        self.client.force_login(self.invitee)
+        self.client.post(reverse('invitation_accept', kwargs={'pk': self.invitation.pk}))
+        response = self.client.post(reverse('invitation_accept', kwargs={'pk': self.invitation.pk}))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async_accept(self):
+        await self.async_client.aforce_login(self.invitee)
+        response = await self.async_client.post(reverse('async_invitation_accept', kwargs={'pk': self.invitation.pk}))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(await self.invitee.groups.filter(pk=self.admin_group.pk).aexists())
+
+    async def test_async_accept_someone_elses(self):
+        await self.async_client.aforce_login(self.stranger)
+        response = await self.async_client.post(reverse('async_invitation_accept', kwargs={'pk': self.invitation.pk}))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(await self.stranger.groups.filter(pk=self.admin_group.pk).aexists())
+        self.assertFalse((await Invitation.objects.aget(pk=self.invitation.pk)).accepted)
+
+    async def test_async_accept_is_atomic(self):
+        # If the membership can't be added, the invitation stays pending
+        await self.async_client.aforce_login(self.invitee)
+        with mock.patch.object(User.groups.related_manager_cls, 'add', side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            await self.async_client.post(reverse('async_invitation_accept', kwargs={'pk': self.invitation.pk}))
+        self.assertFalse((await Invitation.objects.aget(pk=self.invitation.pk)).accepted)
+
+    def test_model_accept_someone_elses(self):
+        with self.assertRaises(PermissionDenied):
+            self.invitation.accept(self.stranger)
+        self.assertAccepted(self.stranger, False)
+
+    def test_reject_and_cancel_someone_elses(self):
+        self.client.force_login(self.stranger)
+        self.assertEqual(self.client.post(reverse('invitation_reject', kwargs={'pk': self.invitation.pk})).status_code, 404)
+        self.assertEqual(self.client.post(reverse('invitation_cancel', kwargs={'pk': self.invitation.pk})).status_code, 404)
+        self.assertTrue(Invitation.objects.filter(pk=self.invitation.pk).exists())
+
+
+@override_settings(ENTITY_PERMS_CACHE_TIMEOUT=300)
+class EntityPermsCacheTests(TestCase):
+    # Every change to memberships, object permissions, global permissions or the hierarchy reaches the cached permissions
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.member = User.objects.create_user('member', 'member@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+        cls.other_organisation = Organisation.objects.create(name='Other', organisation_fields='Other', created_by=cls.owner)
+        cls.business = Business.objects.create(name='Biz', business_fields='Biz', parent=cls.organisation, created_by=cls.owner)
+        cls.admin_group = cls.organisation.get_group(settings.ENTITY_ROLE_ADMIN)
+
+    def setUp(self):
+        cache.clear()
+
+    def has_perm(self, user, entity, perm): # Through a fresh user object, so only the cache can carry stale permissions
+        return get_entity_perms(User.objects.get(pk=user.pk)).has_perm(entity, perm)
+
+    def test_membership(self):
+        self.assertFalse(self.has_perm(self.member, self.business, 'change'))
+        self.member.groups.add(self.admin_group)
+        self.assertTrue(self.has_perm(self.member, self.business, 'change'))
+        self.admin_group.user_set.remove(self.member)
+        self.assertFalse(self.has_perm(self.member, self.business, 'change'))
+
+    def test_group_object_permission(self):
+        self.member.groups.add(self.admin_group)
+        self.assertTrue(self.has_perm(self.member, self.organisation, 'delete'))
+        remove_perm('delete_organisation', self.admin_group, self.organisation)
+        self.assertFalse(self.has_perm(self.member, self.organisation, 'delete'))
+        assign_perm('delete_organisation', self.admin_group, self.organisation)
+        self.assertTrue(self.has_perm(self.member, self.organisation, 'delete'))
+
+    def test_user_object_permission(self):
+        self.assertFalse(self.has_perm(self.member, self.business, 'view'))
+        assign_perm('view_organisation', self.member, self.organisation)
+        self.assertTrue(self.has_perm(self.member, self.business, 'view'))
+        remove_perm('view_organisation', self.member, self.organisation)
+        self.assertFalse(self.has_perm(self.member, self.business, 'view'))
+
+    def test_global_permission(self):
+        permission = Permission.objects.get(codename='view_business')
+        self.assertFalse(self.has_perm(self.member, self.business, 'view'))
+        self.member.user_permissions.add(permission)
+        self.assertTrue(self.has_perm(self.member, self.business, 'view'))
+        permission.user_set.remove(self.member)
+        self.assertFalse(self.has_perm(self.member, self.business, 'view'))
+
+    def test_superuser(self):
+        self.member.is_superuser = True
+        self.member.save()
+        self.assertTrue(self.has_perm(self.member, self.business, 'delete'))
+        self.member.is_superuser = False
+        self.member.save()
+        self.assertFalse(self.has_perm(self.member, self.business, 'delete'))
+
+    def test_move(self):
+        self.member.groups.add(self.admin_group)
+        self.assertTrue(self.has_perm(self.member, self.business, 'change'))
+        self.business.move_to(self.other_organisation)
+        self.assertFalse(self.has_perm(self.member, self.business, 'change'))
+
+    def test_delete(self):
+        self.member.groups.add(self.admin_group)
+        self.assertTrue(self.has_perm(self.member, self.business, 'change'))
+        self.organisation.delete()
+        self.assertEqual(get_entity_perms(User.objects.get(pk=self.member.pk)).entity_perms, {})
+
+
+class TaskLeaseTests(TestCase):
+    # Tasks left running by a worker that died are retried once their lease expires
+
+    def create_task(self, attempts, claimed_seconds_ago):
+        return Task.objects.create(
+            name=record_invitations_accepted.task_name, args=[[1], 1], status=Task.RUNNING, attempts=attempts,
+            claimed_at=timezone.now() - timedelta(seconds=claimed_seconds_ago),
+        )
+
+    def test_stale_task_is_retried(self):
+        task = self.create_task(attempts=1, claimed_seconds_ago=settings.TASK_LEASE_TIMEOUT + 1)
+        with self.assertLogs('multiuser.tasks', 'WARNING'):
+            self.assertEqual(run_pending_tasks(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.DONE, 2))
+
+    def test_stale_task_out_of_attempts_fails(self):
+        task = self.create_task(attempts=settings.TASK_MAX_ATTEMPTS, claimed_seconds_ago=settings.TASK_LEASE_TIMEOUT + 1)
+        with self.assertLogs('multiuser.tasks', 'WARNING'):
+            self.assertEqual(run_pending_tasks(), 0)
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.FAILED)
+
+    def test_running_task_is_left_alone(self):
+        task = self.create_task(attempts=1, claimed_seconds_ago=1)
+        self.assertEqual(run_pending_tasks(), 0)
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.RUNNING)
+
+
+class KeysetPaginationTests(TestCase):
+    # Malformed ?after= cursors are a 404, not a server error
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.members = build_hierarchy([3, 1, 1], users=0, seed=0)
+
+    def get_list(self, name, values):
+        cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+        return self.client.get(reverse(name), {'after': cursor})
+
+    def test_invalid_cursors(self):
+        self.client.force_login(self.owner)
+        for name in ['organisation_list', 'async_organisation_list', 'api_organisation_list']:
+            for values in [['a', 'notanint'], ['a'], ['a', None], {'name': 'a'}]:
+                with self.subTest(name=name, values=values):
+                    self.assertEqual(self.get_list(name, values).status_code, 404)
+            self.assertEqual(self.client.get(reverse(name), {'after': 'not base64!'}).status_code, 404)
+
+    def test_next_page(self):
+        self.client.force_login(self.owner)
+        first = Organisation.objects.order_by('name', 'pk').first()
+        response = self.get_list('organisation_list', [first.name, first.pk])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['object_list']), 2)
+
+
+class BulkInviteTests(TestCase):
+    # Invitation.bulk_invite and the bulk API validate every row, check permissions and skip pending duplicates
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.stranger = User.objects.create_user('stranger', 'stranger@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+        cls.business = Business.objects.create(name='Biz', business_fields='Biz', parent=cls.organisation, created_by=cls.owner)
+
+    def post(self, user, data):
+        self.client.force_login(user)
+        return self.client.post(reverse('api_invitation_bulk_create'), json.dumps(data), content_type='application/json')
+
+    def test_invite(self):
+        rows = [('a@example.com', self.organisation.pk, 'Admin'), ('b@example.com', self.business.pk, 'User')]
+        created, skipped = Invitation.bulk_invite(self.owner, rows)
+        self.assertEqual([(invitation.email, invitation.entity_id, invitation.role) for invitation in created], rows)
+        self.assertTrue(all(invitation.pk for invitation in created))
+        self.assertEqual(skipped, [])
+
+    def test_duplicates_are_skipped(self):
+        Invitation.objects.create(email='a@example.com', entity=self.organisation, role='Admin', invited_by=self.stranger)
+        rows = [('a@example.com', self.organisation.pk, 'Admin'), ('b@example.com', self.organisation.pk, 'Admin'), ('b@example.com', self.organisation.pk, 'Admin')]
+        created, skipped = Invitation.bulk_invite(self.owner, rows)
+        self.assertEqual([invitation.email for invitation in created], ['b@example.com'])
+        self.assertEqual(skipped, [rows[0], rows[2]])
+        self.assertEqual(Invitation.objects.filter(accepted=False).count(), 2)
+
+    def test_own_duplicates_are_not_created_again(self):
+        Invitation.bulk_invite(self.owner, [('a@example.com', self.organisation.pk, 'Admin')])
+        rows = [('a@example.com', self.organisation.pk, 'Admin'), ('b@example.com', self.organisation.pk, 'Admin')]
+        created, skipped = Invitation.bulk_invite(self.owner, rows)
+        self.assertEqual([invitation.email for invitation in created], ['b@example.com'])
+        self.assertEqual(skipped, [rows[0]])
+
+    def test_accepted_invitations_are_not_duplicates(self):
+        Invitation.objects.create(email='a@example.com', entity=self.organisation, role='Admin', invited_by=self.owner, accepted=True)
+        created, skipped = Invitation.bulk_invite(self.owner, [('a@example.com', self.organisation.pk, 'Admin')])
+        self.assertEqual((len(created), skipped), (1, []))
+
+    def test_pending_duplicates_are_rejected_by_the_database(self):
+        Invitation.objects.create(email='a@example.com', entity=self.organisation, role='Admin', invited_by=self.owner)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Invitation.objects.create(email='a@example.com', entity=self.organisation, role='Admin', invited_by=self.stranger)
+
+    def test_permission_denied(self):
+        response = self.post(self.stranger, {'emails': ['a@example.com'], 'entities': [self.organisation.pk], 'roles': ['User']})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Invitation.objects.exists())
+
+    def test_invalid_rows(self):
+        for role in ['Owner', ['Admin'], {'role': 'Admin'}, None]:
+            with self.subTest(role=role):
+                response = self.post(self.owner, {'invitations': [{'email': 'a@example.com', 'entity': self.organisation.pk, 'role': role}]})
+                self.assertEqual(response.status_code, 400)
+        response = self.post(self.owner, {'invitations': [{'email': 'not an email', 'entity': 'x', 'role': 'Admin'}]})
+        self.assertEqual(len(json.loads(response.content)['errors']), 2)
+        self.assertFalse(Invitation.objects.exists())
+
+    def test_api_only_accepts_post(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(reverse('api_invitation_bulk_create')).status_code, 405)
+        response = self.post(self.owner, {'invitations': [{'email': 'a@example.com', 'entity': self.organisation.pk, 'role': 'Admin'}]})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([invitation['email'] for invitation in response.json()['created']], ['a@example.com'])
+
+    def test_create_view_rejects_duplicates(self):
+        Invitation.objects.create(email='a@example.com', entity=self.organisation, role='Admin', invited_by=self.owner)
+        self.client.force_login(self.owner)
+        response = self.client.post(reverse('invitation_create'), {'email': 'a@example.com', 'entity': self.organisation.pk, 'role': 'Admin'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'already been invited')
+
+
+@override_settings(FRAGMENT_CACHE_TIMEOUT=300)
+class FragmentCacheTests(TestCase):
+    # Cached fragments are served without their queries, and refreshed when what they show changes
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+        cls.business = Business.objects.create(name='Biz', business_fields='Biz', parent=cls.organisation, created_by=cls.owner)
+
+    def setUp(self):
+        cache.clear()
+
+    def get_detail(self, name):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(name, kwargs={'pk': self.organisation.pk}))
+        return response, len(context)
+
+    def test_detail(self):
+        self.client.force_login(self.owner)
+        for name in ['organisation_detail', 'async_organisation_detail']:
+            with self.subTest(name=name):
+                cache.clear()
+                response, uncached_queries = self.get_detail(name)
+                self.assertContains(response, 'Biz')
+                response, cached_queries = self.get_detail(name)
+                self.assertContains(response, 'Biz')
+                self.assertLess(cached_queries, uncached_queries)
+
+    def test_invalidation(self):
+        self.client.force_login(self.owner)
+        self.get_detail('organisation_detail')
+        self.business.name = 'Renamed'
+        self.business.save()
+        self.assertContains(self.get_detail('async_organisation_detail')[0], 'Renamed')
+        other = Organisation.objects.create(name='Other', organisation_fields='Other', created_by=self.owner)
+        self.business.move_to(other)
+        self.assertNotContains(self.get_detail('organisation_detail')[0], 'Renamed')
+
+
+    def test_evicted_after_lookup(self):
+        # The async view renders the HTML it looked up, even if the fragment is evicted before the template renders
+        self.client.force_login(self.owner)
+        self.get_detail('organisation_detail')
+
+        async def aget_and_evict(*args):
+            html = await aget_fragment(*args)
+            await cache.aclear()
+            return html
+
+        with mock.patch('multiuser.async_views.aget_fragment', side_effect=aget_and_evict):
+            self.assertContains(self.get_detail('async_organisation_detail')[0], 'Biz')
+        self.assertContains(self.get_detail('async_organisation_detail')[0], 'Biz')
+
+    @override_settings(FRAGMENT_CACHE_TIMEOUT=0)
+    def test_disabled(self):
+        # No cache reads or writes for the fragments when fragment caching is off
+        self.client.force_login(self.owner)
+        for name in ['organisation_detail', 'async_organisation_detail']:
+            with self.subTest(name=name), mock.patch.object(LocMemCache, 'get', autospec=True, side_effect=LocMemCache.get) as get:
+                self.assertContains(self.get_detail(name)[0], 'Biz')
+                self.assertFalse([call for call in get.call_args_list if call.args[1].startswith('template.cache.')])
+
+
+class ApiETagTests(TestCase):
+    # Unchanged polls get a 304, without running the view's queries when API_VERSION_ETAGS is on
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.owner)
+
+    def poll(self, name, etag):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(name), headers={'If-None-Match': etag})
+        return response, len(context)
+
+    def test_body_etag(self):
+        etag = self.client.get(reverse('api_organisation_list'))['ETag']
+        self.assertEqual(self.poll('api_organisation_list', etag)[0].status_code, 304)
+
+    @override_settings(API_VERSION_ETAGS=True)
+    def test_version_etag(self):
+        response, queries = self.poll('api_organisation_list', '"none"')
+        etag = response['ETag']
+        self.assertEqual(response.status_code, 200)
+        not_modified, not_modified_queries = self.poll('api_organisation_list', etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertLess(not_modified_queries, queries)
+
+        self.organisation.name = 'Renamed'
+        self.organisation.save()
+        response = self.poll('api_organisation_list', etag)[0]
+        self.assertContains(response, 'Renamed')
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(API_VERSION_ETAGS=True)
+    def test_version_etag_invitations(self):
+        etag = self.client.get(reverse('api_invitationreceived_list'))['ETag']
+        Invitation.objects.create(email=self.owner.email, entity=self.organisation, role='User', invited_by=self.owner)
+        self.assertEqual(self.poll('api_invitationreceived_list', etag)[0].status_code, 200)
+        etag = self.client.get(reverse('api_invitationreceived_list'))['ETag']
+        Invitation.objects.filter(email=self.owner.email).accept(self.owner)
+        self.assertEqual(self.poll('api_invitationreceived_list', etag)[0].status_code, 200)
+
+
+class PermissionResolutionTests(TestCase):
+    # The closure table resolves permissions like guardian does when every ancestor's object permissions are checked,
+    # with global permissions covering a model and the models below it
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.members = build_hierarchy([2, 2, 2], users=6, seed=0)
+        members = list(cls.members)
+        entities = list(Entity.objects.select_subclasses().order_by('pk'))
+        assign_perm('view_business', members[0], next(entity for entity in entities if isinstance(entity, Business)))
+        members[1].user_permissions.add(Permission.objects.get(codename='change_business'))
+        cls.users = [cls.owner, *members]
+
+    def get_expected(self, user, perm):
+        # Entities on which guardian finds the permission on the entity or an ancestor, or the user holds it globally
+        user = User.objects.get(pk=user.pk)
+        checker = ObjectPermissionChecker(user)
+        expected = set()
+        for entity in Entity.objects.select_subclasses():
+            ancestors = []
+            ancestor = entity
+            while ancestor is not None:
+                ancestors.append(ancestor)
+                ancestor = ancestor.parent and Entity.objects.get_subclass(pk=ancestor.parent_id)
+            if any(user.has_perm(f'multiuser.{perm}_{ancestor._meta.model_name}') for ancestor in ancestors) or any(
+                checker.has_perm(f'{perm}_{ancestor._meta.model_name}', ancestor) for ancestor in ancestors
+            ):
+                expected.add(entity.pk)
+        return expected
+
+    def test_matches_guardian(self):
+        for user in self.users:
+            for perm in ['view', 'change', 'delete']:
+                with self.subTest(user=user.username, perm=perm):
+                    expected = self.get_expected(user, perm)
+                    user = User.objects.get(pk=user.pk)
+                    by_model = set()
+                    for model in Entity.get_all_models():
+                        by_model |= set(model.get_objects_for_user(user, perm).values_list('pk', flat=True))
+                    self.assertEqual(by_model, expected)
+                    self.assertEqual(set(Entity.get_entities_for_user(user, perm).values_list('pk', flat=True)), expected)
+                    perms = get_entity_perms(user)
+                    self.assertEqual({entity.pk for entity in Entity.objects.select_subclasses() if perms.has_perm(entity, perm)}, expected)
+
+    def test_superuser(self):
+        superuser = User.objects.create_superuser('root', 'root@example.com')
+        self.assertEqual(Branch.get_objects_for_user(superuser, 'delete').count(), Branch.objects.count())
+
+    def test_closure_table(self):
+        # One row per entity and each of its ancestors, kept up to date on create, reparent and delete
+        organisation, other = Organisation.objects.order_by('pk')[:2]
+        business = Business.objects.create(name='New', business_fields='New', parent=organisation, created_by=self.owner)
+        branch = Branch.objects.create(name='New', branch_fields='New', parent=business, created_by=self.owner)
+        self.assertEqual(sorted(EntityAncestor.objects.filter(entity=branch).values_list('ancestor_id', 'depth')), sorted([(branch.pk, 0), (business.pk, 1), (organisation.pk, 2)]))
+        business.parent = other
+        business.save()
+        self.assertEqual(sorted(EntityAncestor.objects.filter(entity=branch).values_list('ancestor_id', 'depth')), sorted([(branch.pk, 0), (business.pk, 1), (other.pk, 2)]))
+        business.delete()
+        self.assertFalse(EntityAncestor.objects.filter(Q(entity_id__in=[business.pk, branch.pk]) | Q(ancestor_id__in=[business.pk, branch.pk])).exists())
+
+
+class GroupProvisioningTests(TestCase):
+    # Groups and their permissions are provisioned when an entity is created, and only renamed on later saves
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+
+    def get_groups(self):
+        return {role: (group.pk, group.name) for role, group in ((role, self.organisation.get_group(role)) for role in settings.ENTITY_ROLES)}
+
+    def test_create(self):
+        for role, role_data in settings.ENTITY_ROLES.items():
+            group = self.organisation.get_group(role)
+            self.assertEqual(group.name, self.organisation.get_group_name(role))
+            checker = ObjectPermissionChecker(group)
+            for perm in ['view', 'change', 'delete']:
+                self.assertEqual(checker.has_perm(f'{perm}_organisation', self.organisation), perm in role_data['permissions'])
+        self.assertTrue(self.owner.groups.filter(pk=self.organisation.get_group(settings.ENTITY_ROLE_ADMIN).pk).exists())
+
+    def test_update_does_not_provision(self):
+        groups = self.get_groups()
+        with CaptureQueriesContext(connection) as context:
+            self.organisation.organisation_fields = 'Changed'
+            self.organisation.save()
+        self.assertFalse([query['sql'] for query in context.captured_queries if 'auth_group' in query['sql'] or 'guardian' in query['sql']])
+        self.assertEqual(self.get_groups(), groups)
+
+    def test_rename(self):
+        groups = self.get_groups()
+        group_count = Group.objects.count()
+        self.organisation.name = 'Renamed'
+        self.organisation.save()
+        for role, (pk, name) in self.get_groups().items():
+            self.assertEqual(pk, groups[role][0]) # Renamed in place
+            self.assertEqual(name, self.organisation.get_group_name(role))
+            self.assertIn('Renamed', name)
+        self.assertEqual(Group.objects.count(), group_count)
+
+
+class EntityRoleGroupTests(TestCase):
+    # Groups are found through the EntityRoleGroup mapping, not by name
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+
+    def test_lookup_is_name_independent(self):
+        group = self.organisation.get_group(settings.ENTITY_ROLE_ADMIN)
+        group.name = 'Something else'
+        group.save()
+        self.assertEqual(self.organisation.get_group(settings.ENTITY_ROLE_ADMIN), group)
+        self.assertEqual(EntityRoleGroup.objects.get(group=group).role, settings.ENTITY_ROLE_ADMIN)
+
+    def test_one_group_per_role(self):
+        self.assertEqual(
+            sorted(EntityRoleGroup.objects.filter(entity=self.organisation).values_list('role', flat=True)),
+            sorted(settings.ENTITY_ROLES),
+        )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            EntityRoleGroup.objects.create(entity=self.organisation, role=settings.ENTITY_ROLE_ADMIN, group=Group.objects.create(name='Extra'))
+
+    def test_detail_view_roles(self):
+        member = User.objects.create_user('member', 'member@example.com')
+        member.groups.add(self.organisation.get_group(settings.ENTITY_ROLE_USER))
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('organisation_detail', kwargs={'pk': self.organisation.pk}))
+        self.assertEqual([(member['username'], member['role']) for member in response.context['members']], [('member', settings.ENTITY_ROLE_USER)])
+
+    def test_delete_removes_groups(self):
+        group_ids = list(Group.objects.filter(entity_role__entity=self.organisation).values_list('pk', flat=True))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.organisation.delete()
+        run_pending_tasks()
+        self.assertFalse(Group.objects.filter(pk__in=group_ids).exists())
+
+
+class InvitationBulkAcceptTests(TestCase):
+    # Bulk accept only ever touches the pending invitations sent to the current user's email
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.invitee = User.objects.create_user('invitee', 'invitee@example.com')
+        cls.stranger = User.objects.create_user('stranger', 'stranger@example.com')
+        cls.organisations = [
+            Organisation.objects.create(name=f'Org {i}', organisation_fields='Org', created_by=cls.owner) for i in range(3)
+        ]
+
+    def setUp(self):
+        self.own = [
+            Invitation.objects.create(email=self.invitee.email, entity=organisation, role=settings.ENTITY_ROLE_USER, invited_by=self.owner)
+            for organisation in self.organisations
+        ]
+        self.other = Invitation.objects.create(
+            email=self.stranger.email, entity=self.organisations[0], role=settings.ENTITY_ROLE_ADMIN, invited_by=self.owner,
+        )
+        self.client.force_login(self.invitee)
+
+    def accept(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('invitation_bulk_accept'), data)
+        self.assertRedirects(response, reverse('invitationreceived_list'))
+
+    def get_accepted(self):
+        return set(Invitation.objects.filter(accepted=True).values_list('pk', flat=True))
+
+    def get_groups(self, user):
+        return set(user.groups.values_list('pk', flat=True))
+
+    def test_accept_all(self):
+        self.accept({'all': ''})
+        self.assertEqual(self.get_accepted(), {invitation.pk for invitation in self.own})
+        self.assertEqual(self.get_groups(self.invitee), {
+            organisation.get_group(settings.ENTITY_ROLE_USER).pk for organisation in self.organisations
+        })
+        self.assertFalse(self.get_groups(self.stranger))
+
+    def test_accept_selected(self):
+        self.accept({'invitation': [self.own[0].pk, self.other.pk, 'x']})
+        self.assertEqual(self.get_accepted(), {self.own[0].pk})
+        self.assertEqual(self.get_groups(self.invitee), {self.organisations[0].get_group(settings.ENTITY_ROLE_USER).pk})
+        self.assertNotIn(self.organisations[0].get_group(settings.ENTITY_ROLE_ADMIN).pk, self.get_groups(self.invitee))
+
+    def test_accepted_once(self):
+        self.accept({'all': ''})
+        self.invitee.groups.clear()
+        self.accept({'all': ''})
+        self.assertFalse(self.get_groups(self.invitee)) # Already accepted invitations grant nothing again
+
+    def test_query_count(self):
+        # Accepting one invitation or many takes the same number of queries
+        Invitation.objects.exclude(pk=self.own[0].pk).delete()
+        with CaptureQueriesContext(connection) as single:
+            self.accept({'all': ''})
+        Invitation.objects.update(accepted=False)
+        self.invitee.groups.clear()
+        for organisation in self.organisations[1:]:
+            Invitation.objects.create(email=self.invitee.email, entity=organisation, role=settings.ENTITY_ROLE_USER, invited_by=self.owner)
+        with CaptureQueriesContext(connection) as bulk:
+            self.accept({'all': ''})
+        self.assertEqual(len(bulk), len(single))
+        self.assertEqual(len(self.get_accepted()), len(self.organisations))
+
+    def test_accept_many(self):
+        # More invitations than SQLite allows conditions in one expression
+        organisations = Organisation.bulk_create_with_groups([
+            Organisation(name=f'Bulk {i}', organisation_fields='Org', created_by=self.owner) for i in range(600)
+        ])
+        Invitation.objects.bulk_create([
+            Invitation(email=self.invitee.email, entity=organisation, role=role, invited_by=self.owner)
+            for organisation in organisations for role in settings.ENTITY_ROLES
+        ])
+        self.accept({'all': ''})
+        self.assertEqual(len(self.get_accepted()), len(self.own) + len(organisations) * len(settings.ENTITY_ROLES))
+        self.assertEqual(self.invitee.groups.filter(entity_role__entity__in=organisations).count(), len(organisations) * len(settings.ENTITY_ROLES))
+
+
+class BulkCreateTests(TestCase):
+    # Entities created in bulk get the same ancestor links, path and groups as entities created one at a time
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+
+    def assertProvisioned(self, business):
+        self.assertEqual(business.parent_id, self.organisation.pk)
+        self.assertEqual(business.path, f'{self.organisation.path}{business.pk}/')
+        self.assertEqual(
+            sorted(EntityAncestor.objects.filter(entity=business).values_list('ancestor_id', 'depth')),
+            sorted([(business.pk, 0), (self.organisation.pk, 1)]),
+        )
+        self.assertEqual(EntityRoleGroup.objects.filter(entity=business).count(), len(settings.ENTITY_ROLES))
+        self.assertTrue(self.owner.groups.filter(pk=business.get_group(settings.ENTITY_ROLE_ADMIN).pk).exists())
+        self.assertTrue(get_entity_perms(User.objects.get(pk=self.owner.pk)).has_perm(business, 'change'))
+
+    def test_string_parent_id(self):
+        objs = Business.bulk_create_with_groups([
+            Business(name=f'Biz {i}', business_fields='Biz', parent_id=str(self.organisation.pk), created_by=self.owner) for i in range(3)
+        ], batch_size=2)
+        for obj in objs:
+            self.assertProvisioned(Business.objects.get(pk=obj.pk))
+
+    def test_wrong_parent(self):
+        with self.assertRaises(ValidationError):
+            Business.bulk_create_with_groups([Business(name='Biz', business_fields='Biz', created_by=self.owner)])
+        with self.assertRaises(ValidationError):
+            Branch.bulk_create_with_groups([Branch(name='Branch', branch_fields='Branch', parent_id=str(self.organisation.pk), created_by=self.owner)])
+
+    def import_entities(self, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write(f'name,parent,business_fields\nBiz 1,{self.organisation.pk},Biz\nBiz 2,{self.organisation.pk},Biz\n')
+        self.addCleanup(os.remove, csv_file.name)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_entities', 'Business', csv_file.name, '--created-by', 'owner', *args, stdout=io.StringIO())
+        self.assertEqual(Business.objects.count(), 2)
+        for business in Business.objects.all():
+            self.assertProvisioned(business)
+
+    def test_import(self):
+        self.import_entities()
+
+    def test_import_background(self):
+        self.import_entities('--background')
+
+
+class BenchmarkTests(TestCase):
+    # The synthetic data generator and the measurements behind benchmark_views and generate_platter_data
+
+    def test_duplicate_invitations(self):
+        # Far more random invitations per member than there are entity and role pairs
+        owner, members = build_hierarchy([1, 1, 1], users=5, seed=0, invitations=20)
+        pending = Invitation.objects.filter(accepted=False)
+        self.assertTrue(pending.exists())
+        self.assertEqual(pending.count(), len(set(pending.values_list('email', 'entity_id', 'role'))))
+
+    def test_measure(self):
+        owner, members = build_hierarchy([2, 2, 2], users=0, seed=0)
+        self.client.force_login(owner)
+        url = reverse('organisation_list')
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url)
+        queries = len(context) # Read before the next request resets the query log
+        result = measure(self.client, url, repeat=3)
+        self.assertEqual(result['queries'], queries)
+        self.assertGreater(result['sql_ms'], 0) # Sub-millisecond queries still count
+        self.assertGreaterEqual(result['wall_ms'], result['sql_ms'])
+
+
+class EntityMembersTests(TestCase):
+    # The users panel lists the members of the entity's own groups and of its ancestors' groups
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.direct = User.objects.create_user('direct', 'direct@example.com')
+        cls.inherited = User.objects.create_user('inherited', 'inherited@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+        cls.business = Business.objects.create(name='Biz', business_fields='Biz', parent=cls.organisation, created_by=cls.owner)
+        cls.business_group = cls.business.get_group(settings.ENTITY_ROLE_USER)
+        cls.organisation_group = cls.organisation.get_group(settings.ENTITY_ROLE_USER)
+        cls.direct.groups.add(cls.business_group)
+        cls.inherited.groups.add(cls.organisation_group)
+
+    def get_removeuser_url(self, user, group):
+        return reverse('business_removeuser', kwargs={'pk': self.business.pk, 'user_pk': user.pk, 'group_pk': group.pk})
+
+    def test_inherited_members(self):
+        self.client.force_login(self.owner)
+        for name in ['business_detail', 'async_business_detail']:
+            with self.subTest(name=name):
+                response = self.client.get(reverse(name, kwargs={'pk': self.business.pk}))
+                members = {member['username']: member for member in response.context['members']}
+                self.assertEqual(members['direct']['depth'], 0)
+                self.assertEqual((members['inherited']['depth'], members['inherited']['entity_name']), (1, 'Org'))
+                self.assertNotIn('owner', members) # The current user is left out
+                self.assertContains(response, self.get_removeuser_url(self.direct, self.business_group))
+                self.assertNotContains(response, self.get_removeuser_url(self.inherited, self.organisation_group))
+                self.assertContains(response, 'Inherited from Org')
+
+
+class EntitySubtreeApiTests(TestCase):
+    # The subtree endpoint returns the whole tree below an entity in a constant number of queries
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.member = User.objects.create_user('member', 'member@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+        cls.business = Business.objects.create(name='Biz A', business_fields='A', parent=cls.organisation, created_by=cls.owner)
+        cls.branch = Branch.objects.create(name='Branch', branch_fields='Branch', parent=cls.business, created_by=cls.owner)
+        # Imported the way import_entities does it, with the parent id as read from the CSV
+        cls.imported, = Business.bulk_create_with_groups([
+            Business(name='Biz B', business_fields='B', parent_id=str(cls.organisation.pk), created_by=cls.owner)
+        ])
+        cls.member.groups.add(cls.business.get_group(settings.ENTITY_ROLE_USER))
+
+    def get_subtree(self, user, entity, **params):
+        self.client.force_login(user)
+        return self.client.get(reverse('api_entity_subtree', kwargs={'pk': entity.pk}), params)
+
+    def test_tree(self):
+        data = self.get_subtree(self.owner, self.organisation, fields='id,type,business_fields').json()
+        self.assertEqual(data, {'id': self.organisation.pk, 'type': 'organisation', 'children': [
+            {'id': self.business.pk, 'type': 'business', 'business_fields': 'A', 'children': [
+                {'id': self.branch.pk, 'type': 'branch', 'children': []},
+            ]},
+            {'id': self.imported.pk, 'type': 'business', 'business_fields': 'B', 'children': []},
+        ]})
+
+    def test_permissions(self):
+        data = self.get_subtree(self.member, self.business, fields='id,permissions').json()
+        view_only = {settings.ENTITY_PERM_VIEW: True, settings.ENTITY_PERM_CHANGE: False, settings.ENTITY_PERM_DELETE: False}
+        self.assertEqual(data, {'id': self.business.pk, 'permissions': view_only, 'children': [
+            {'id': self.branch.pk, 'permissions': view_only, 'children': []}, # Inherited from the business
+        ]})
+        self.assertEqual(self.get_subtree(self.member, self.organisation).status_code, 404)
+        self.assertEqual(self.get_subtree(self.member, self.imported).status_code, 404)
+
+    def test_constant_queries(self):
+        def count_queries():
+            cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                response = self.get_subtree(self.owner, self.organisation)
+            self.assertEqual(response.status_code, 200)
+            return len(context), len(json.dumps(response.json()))
+
+        count_queries() # Warms up the content type cache
+        before, before_size = count_queries()
+        build_hierarchy([1, 3, 3], users=0, seed=0)
+        for business in Business.objects.exclude(parent=self.organisation):
+            business.move_to(self.organisation)
+        after, after_size = count_queries()
+        self.assertGreater(after_size, before_size)
+        self.assertEqual(after, before)
+
+
+class ArchiveInvitationsTests(TestCase):
+    # archive_invitations moves accepted invitations out of the Invitation table in batches, and can be rerun
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', 'owner@example.com')
+        cls.organisation = Organisation.objects.create(name='Org', organisation_fields='Org', created_by=cls.owner)
+
+    def setUp(self):
+        self.accepted = [
+            Invitation.objects.create(email=f'{i}@example.com', entity=self.organisation, role='User', invited_by=self.owner, accepted=True)
+            for i in range(5)
+        ]
+        self.pending = Invitation.objects.create(email='pending@example.com', entity=self.organisation, role='User', invited_by=self.owner)
+
+    def archive(self, *args):
+        call_command('archive_invitations', '--batch-size', '2', *args, stdout=io.StringIO())
+
+    def assertArchived(self):
+        self.assertEqual(list(Invitation.objects.values_list('pk', flat=True)), [self.pending.pk])
+        self.assertEqual(
+            sorted(ArchivedInvitation.objects.values_list('invitation_id', 'email', 'entity_id', 'role', 'invited_by_id')),
+            [(invitation.pk, invitation.email, self.organisation.pk, 'User', self.owner.pk) for invitation in self.accepted],
+        )
+
+    def test_archive(self):
+        self.archive()
+        self.assertArchived()
+
+    def test_purge(self):
+        self.archive('--purge')
+        self.assertEqual(list(Invitation.objects.values_list('pk', flat=True)), [self.pending.pk])
+        self.assertFalse(ArchivedInvitation.objects.exists())
+
+    def test_rerun_after_interruption(self):
+        # The second batch fails, leaving the first archived and the rest in place
+        bulk_create = ArchivedInvitation.objects.bulk_create
+        calls = []
+
+        def fail_second_batch(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise DatabaseError
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(ArchivedInvitation.objects, 'bulk_create', side_effect=fail_second_batch), self.assertRaises(DatabaseError):
+            self.archive()
+        self.assertEqual(ArchivedInvitation.objects.count(), 2)
+        self.assertEqual(Invitation.objects.count(), 4)
+        self.archive()
+        self.assertArchived()
+
+    def test_rerun_with_archived_copy(self):
+        # A row already archived while its invitation is still in the table is not archived twice
+        invitation = self.accepted[0]
+        ArchivedInvitation.objects.create(invitation_id=invitation.pk, email=invitation.email, entity=self.organisation, role='User', invited_by=self.owner)
+        self.archive()
+        self.assertArchived()
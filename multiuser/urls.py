@@ -1,11 +1,13 @@
 from django.urls import path
-from . import views
+from . import views, api, async_views
 
 urlpatterns = [
     # path('test/', views.TestView.as_view(), name='test'),
     path('invitation/create/', views.InvitationCreateView.as_view(), name='invitation_create'),
+    path('invitation/entities/', views.InvitationEntityAutocompleteView.as_view(), name='invitation_entity_autocomplete'),
     path('invitation/sent/', views.InvitationSentListView.as_view(), name='invitationsent_list'),
     path('invitation/received/', views.InvitationReceivedListView.as_view(), name='invitationreceived_list'),
+    path('invitation/accept/', views.InvitationBulkAcceptView.as_view(), name='invitation_bulk_accept'),
     path('invitation/<int:pk>/accept/', views.InvitationAcceptView.as_view(), name='invitation_accept'),
     path('invitation/<int:pk>/reject/', views.InvitationRejectView.as_view(), name='invitation_reject'),
     path('invitation/<int:pk>/cancel/', views.InvitationCancelView.as_view(), name='invitation_cancel'),
@@ -20,12 +22,33 @@ urlpatterns = [
     path('business/<int:pk>/', views.BusinessDetailView.as_view(), name='business_detail'),
     path('business/<int:pk>/removeuser/<int:user_pk>/<int:group_pk>/', views.BusinessDetailView.as_view(), name='business_removeuser'),
     path('business/<int:pk>/update/', views.BusinessUpdateView.as_view(), name='business_update'),
+    path('business/<int:pk>/move/', views.BusinessMoveView.as_view(), name='business_move'),
     path('business/<int:pk>/delete/', views.BusinessDeleteView.as_view(), name='business_delete'),
     path('branch/', views.BranchListView.as_view(), name='branch_list'),
     path('branch/create/', views.BranchCreateView.as_view(), name='branch_create'),
     path('branch/<int:pk>/', views.BranchDetailView.as_view(), name='branch_detail'),
     path('branch/<int:pk>/removeuser/<int:user_pk>/<int:group_pk>/', views.BranchDetailView.as_view(), name='branch_removeuser'),
     path('branch/<int:pk>/update/', views.BranchUpdateView.as_view(), name='branch_update'),
+    path('branch/<int:pk>/move/', views.BranchMoveView.as_view(), name='branch_move'),
     path('branch/<int:pk>/delete/', views.BranchDeleteView.as_view(), name='branch_delete'),
+    path('async/invitation/sent/', async_views.AsyncInvitationSentListView.as_view(), name='async_invitationsent_list'),
+    path('async/invitation/received/', async_views.AsyncInvitationReceivedListView.as_view(), name='async_invitationreceived_list'),
+    path('async/invitation/<int:pk>/accept/', async_views.AsyncInvitationAcceptView.as_view(), name='async_invitation_accept'),
+    path('async/organisation/', async_views.AsyncOrganisationListView.as_view(), name='async_organisation_list'),
+    path('async/organisation/<int:pk>/', async_views.AsyncOrganisationDetailView.as_view(), name='async_organisation_detail'),
+    path('async/business/', async_views.AsyncBusinessListView.as_view(), name='async_business_list'),
+    path('async/business/<int:pk>/', async_views.AsyncBusinessDetailView.as_view(), name='async_business_detail'),
+    path('async/branch/', async_views.AsyncBranchListView.as_view(), name='async_branch_list'),
+    path('async/branch/<int:pk>/', async_views.AsyncBranchDetailView.as_view(), name='async_branch_detail'),
+    path('api/entity/<int:pk>/subtree/', api.EntitySubtreeApiView.as_view(), name='api_entity_subtree'),
+    path('api/invitation/bulk/', api.InvitationBulkCreateApiView.as_view(), name='api_invitation_bulk_create'),
+    path('api/invitation/sent/', api.InvitationSentListApiView.as_view(), name='api_invitationsent_list'),
+    path('api/invitation/received/', api.InvitationReceivedListApiView.as_view(), name='api_invitationreceived_list'),
+    path('api/organisation/', api.OrganisationListApiView.as_view(), name='api_organisation_list'),
+    path('api/organisation/<int:pk>/', api.OrganisationDetailApiView.as_view(), name='api_organisation_detail'),
+    path('api/business/', api.BusinessListApiView.as_view(), name='api_business_list'),
+    path('api/business/<int:pk>/', api.BusinessDetailApiView.as_view(), name='api_business_detail'),
+    path('api/branch/', api.BranchListApiView.as_view(), name='api_branch_list'),
+    path('api/branch/<int:pk>/', api.BranchDetailApiView.as_view(), name='api_branch_detail'),
 ]
 
@@ -1,15 +1,85 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse, Http404
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User, Group
 from django.views.generic import ListView, CreateView, DetailView, UpdateView, DeleteView, View
 from django.urls import reverse_lazy, reverse
-from django.db.models import Prefetch, F
+from django.db.models import F, Q
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.utils.functional import SimpleLazyObject
 from django.conf import settings
 from .models import Invitation, Entity, Organisation, Business, Branch
-from guardian.shortcuts import get_objects_for_user, get_groups_with_perms, get_users_with_perms
+from .fragments import get_fragment_version
+from .tasks import send_invitation_email, record_invitation_accepted, record_invitations_accepted
+from guardian.shortcuts import get_objects_for_user
+import base64
+import json
+
+
+class KeysetPaginationMixin:
+    # Pages through the queryset by the ordering values of the last row shown (?after=<cursor>) rather than by offset,
+    # so every page costs the same indexed range scan and rows don't shift between pages when others are added
+    ordering_fields = ('pk',) # Must end with a unique field so the ordering is stable
+    page_size = None # Defaults to settings.LIST_PAGE_SIZE
+
+    def get_page_size(self):
+        return self.page_size or settings.LIST_PAGE_SIZE
+
+    def encode_cursor(self, obj):
+        values = [getattr(obj, field) for field in self.ordering_fields]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor, model):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if not isinstance(values, list) or len(values) != len(self.ordering_fields) or None in values:
+                raise ValueError
+            # Convert each value as its ordering field would, so that a tampered cursor can't reach the query
+            fields = [model._meta.pk if name == 'pk' else model._meta.get_field(name) for name in self.ordering_fields]
+            return [field.to_python(value) for field, value in zip(fields, values)]
+        except (ValueError, ValidationError):
+            raise Http404('Invalid cursor')
+
+    def get_keyset_filter(self, values):
+        # (a, b, c) > (x, y, z) expanded to a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        q_objects = Q()
+        for i, field in enumerate(self.ordering_fields):
+            equal = {prev_field: value for prev_field, value in zip(self.ordering_fields[:i], values)}
+            q_objects |= Q(**equal, **{f'{field}__gt': values[i]})
+        return q_objects
+
+    def get_page_queryset(self, queryset): # Returns the rows of the requested page, plus one to tell if there is a next page
+        queryset = queryset.order_by(*self.ordering_fields)
+        cursor = self.request.GET.get('after')
+        if cursor:
+            queryset = queryset.filter(self.get_keyset_filter(self.decode_cursor(cursor, queryset.model)))
+        return queryset[:self.get_page_size() + 1]
+
+    def split_page(self, objects):
+        page_size = self.get_page_size()
+        next_cursor = self.encode_cursor(objects[page_size - 1]) if len(objects) > page_size else None
+        return objects[:page_size], next_cursor
+
+    def paginate_keyset(self, queryset):
+        return self.split_page(list(self.get_page_queryset(queryset)))
+
+    async def apaginate_keyset(self, queryset):
+        return self.split_page([obj async for obj in self.get_page_queryset(queryset)])
+
+    def get_context_data(self, **kwargs):
+        page, next_cursor = self.paginate_keyset(self.object_list)
+        context = super().get_context_data(object_list=page, **kwargs)
+        context['next_cursor'] = next_cursor
+        context['is_first_page'] = not self.request.GET.get('after')
+        return context
+
+
+def entity_label(entity): # Expects a downcast entity
+    return f'{entity} ({entity._meta.verbose_name})'
 
 
-class InvitationSentListView(LoginRequiredMixin, ListView):
+class InvitationSentListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Invitation
     template_name = 'invitation_sent_list.html'
     context_object_name = 'invitations'
@@ -17,11 +87,11 @@ class InvitationSentListView(LoginRequiredMixin, ListView):
     def get_queryset(self):
         user = self.request.user
         queryset = super().get_queryset()
-        queryset = queryset.filter(invited_by=user).filter(accepted=False)
+        queryset = queryset.filter(invited_by=user).filter(accepted=False).with_entities()
         return queryset
 
 
-class InvitationReceivedListView(LoginRequiredMixin, ListView):
+class InvitationReceivedListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Invitation
     template_name = 'invitation_received_list.html'
     context_object_name = 'invitations'
@@ -29,7 +99,7 @@ class InvitationReceivedListView(LoginRequiredMixin, ListView):
     def get_queryset(self):
         user = self.request.user
         queryset = super().get_queryset()
-        queryset = queryset.filter(email=user.email).filter(accepted=False)
+        queryset = queryset.filter(email=user.email).filter(accepted=False).select_related('invited_by').with_entities()
         return queryset
 
 
@@ -41,40 +111,78 @@ class InvitationCreateView(LoginRequiredMixin, CreateView):
 
     def get_form(self, form_class=None):
         form = super().get_form(form_class)
-        user = self.request.user
-        queryset = Entity.objects.none()
+        field = form.fields['entity']
 
         # Only allow the user to invite others to entities for which they have change permission
-        for model in Entity.get_all_models():
-            sub_queryset = model.get_objects_for_user(user, settings.ENTITY_PERM_CHANGE)
-            queryset = queryset | Entity.objects.filter(id__in=sub_queryset) # Upcast to allow union
-        form.fields['entity'].queryset = queryset
+        field.queryset = Entity.get_entities_for_user(self.request.user, settings.ENTITY_PERM_CHANGE)
+
+        # The options are fetched from InvitationEntityAutocompleteView as the user types, so only render the selected one
+        choices = [('', field.empty_label)]
+        selected = form['entity'].value()
+        if selected and str(selected).isdigit():
+            choices += [(entity.pk, entity_label(entity)) for entity in field.queryset.filter(pk=selected)]
+        field.widget.choices = choices
 
         return form
 
     def form_valid(self, form):
         # Assign the user who created the instance to the invited_by field
         form.instance.invited_by = self.request.user 
-        return super().form_valid(form)
+        response = super().form_valid(form)
+        send_invitation_email.delay(self.object.pk)
+        return response
+
+
+class InvitationEntityAutocompleteView(LoginRequiredMixin, View):
+    paginate_by = 20
+
+    # Returns a page of the entities the user can invite others to, filtered by name, for the invitation form
+    def get(self, request, *args, **kwargs):
+        queryset = Entity.get_entities_for_user(request.user, settings.ENTITY_PERM_CHANGE)
+        term = request.GET.get('q', '').strip()
+        if term:
+            queryset = queryset.filter(name__icontains=term)
+        page = request.GET.get('page', '1')
+        page = int(page) if page.isdigit() and int(page) > 0 else 1
+
+        start = (page - 1) * self.paginate_by
+        entities = list(queryset.order_by('name', 'pk')[start:start + self.paginate_by + 1]) # One extra to tell if there is a next page
+        results = [{'id': entity.pk, 'text': entity_label(entity)} for entity in entities[:self.paginate_by]]
+        return JsonResponse({'results': results, 'more': len(entities) > self.paginate_by})
 
 
 class InvitationAcceptView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
-        invitation = get_object_or_404(Invitation, pk=kwargs['pk'])
-        invitation.accept(request.user)
+        # Only the invitee can accept, and only while the invitation is pending
+        invitations = Invitation.objects.filter(pk=kwargs['pk'], email=request.user.email)
+        if not invitations.accept(request.user):
+            raise Http404
+        record_invitation_accepted.delay(kwargs['pk'], request.user.pk)
+        return redirect('invitationreceived_list')
+
+
+class InvitationBulkAcceptView(LoginRequiredMixin, View):
+    # Accepts the received invitations ticked in the list, or all of them
+    def post(self, request, *args, **kwargs):
+        invitations = Invitation.objects.filter(email=request.user.email)
+        if 'all' not in request.POST:
+            invitations = invitations.filter(pk__in=[pk for pk in request.POST.getlist('invitation') if pk.isdigit()])
+        invitation_ids = invitations.accept(request.user)
+        if invitation_ids:
+            record_invitations_accepted.delay(invitation_ids, request.user.pk)
         return redirect('invitationreceived_list')
 
 
 class InvitationRejectView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
-        invitation = get_object_or_404(Invitation, pk=kwargs['pk'])
+        invitation = get_object_or_404(Invitation, pk=kwargs['pk'], email=request.user.email, accepted=False)
         invitation.delete()
         return redirect('invitationreceived_list')
 
 
 class InvitationCancelView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
-        invitation = get_object_or_404(Invitation, pk=kwargs['pk'])
+        invitation = get_object_or_404(Invitation, pk=kwargs['pk'], invited_by=request.user, accepted=False)
         invitation.delete()
         return redirect('invitationsent_list')
 
@@ -93,7 +201,25 @@ class EntityMixin(LoginRequiredMixin):
         return form
 
 
-class EntityListView(EntityMixin, ListView):
+# Returns one row per group membership that gives a user access to the entity, directly or through an ancestor,
+# with the user's name and email, the role and the entity the group belongs to
+def get_entity_members(entity, exclude_user):
+    memberships = User.groups.through.objects.filter(group__entity_role__entity__descendant_links__entity=entity)
+    memberships = memberships.exclude(user=exclude_user) # Exclude the current user
+    memberships = memberships.annotate(
+        username=F('user__username'),
+        email=F('user__email'),
+        role=F('group__entity_role__role'),
+        entity_name=F('group__entity_role__entity__name'),
+        depth=F('group__entity_role__entity__descendant_links__depth'), # 0 for the entity's own groups
+    )
+    memberships = memberships.values('user_id', 'group_id', 'username', 'email', 'role', 'entity_name', 'depth')
+    return memberships.order_by('depth', 'username', 'pk')
+
+
+class EntityListView(EntityMixin, KeysetPaginationMixin, ListView):
+    ordering_fields = ('name', 'pk')
+
     def get_queryset(self):
         return self.model.get_objects_for_user(self.request.user, settings.ENTITY_PERM_VIEW)
 
@@ -113,33 +239,36 @@ class EntityDetailView(EntityMixin, DetailView):
         context = super().get_context_data(**kwargs)
 
         # Whether the user has relevant permissions for the current or ancestor models
-        context['can_change'] = self.object in self.model.get_objects_for_user(self.request.user, settings.ENTITY_PERM_CHANGE)
-        context['can_delete'] = self.object in self.model.get_objects_for_user(self.request.user, settings.ENTITY_PERM_DELETE)
+        context['can_change'] = self.object.user_has_perm(self.request.user, settings.ENTITY_PERM_CHANGE)
+        context['can_delete'] = self.object.user_has_perm(self.request.user, settings.ENTITY_PERM_DELETE)
         
+        # The children list and users panel are cached as template fragments, see fragments.py, so both are
+        # left lazy and only queried when the fragment has to be rendered
+        context['fragment_cache_timeout'] = settings.FRAGMENT_CACHE_TIMEOUT
+        context['fragment_version'] = get_fragment_version(self.object)
+
         # Add children to the context if the model is not a bottom level entity
         if not self.model.is_bottom(): 
-            context['children'] = Entity.objects.filter(parent=self.object)
+            context['children'] = self.model.get_child_model().objects.filter(parent=self.object) # Already downcast
 
         # Current user can manage users if they have change permission 
-        if self.object in self.model.get_objects_for_user(self.request.user, settings.ENTITY_PERM_CHANGE):
-            # Get the groups pertaining to the entity instance
-            groups = get_groups_with_perms(self.object)
-            groups = groups.annotate(role=F('name'))
-            groups = Prefetch('groups', queryset=groups, to_attr='object_groups')
-            # Get the users who have any permission for the entity instance
-            users = get_users_with_perms(self.object)
-            users = users.prefetch_related(groups).exclude(id=self.request.user.id) # Exclude the current user
-            for user in users:
-                for group in user.object_groups:
-                    group.role = Entity.get_role(group.name)
-            context['users'] = users
+        if context['can_change']:
+            members = Paginator(self.get_members(), settings.LIST_PAGE_SIZE)
+            context['members'] = SimpleLazyObject(lambda: members.get_page(self.request.GET.get('users_page')))
+            context['removeuser_url_name'] = f'{self.model._meta.model_name}_removeuser'
 
         return context
 
+    def get_members(self):
+        return get_entity_members(self.object, exclude_user=self.request.user)
+
     def post(self, request, *args, **kwargs):
         if '/removeuser/' in self.request.path:
+            entity = self.get_object()
+            if not entity.user_has_perm(request.user, settings.ENTITY_PERM_CHANGE):
+                raise PermissionDenied
             user = get_object_or_404(User, pk=self.kwargs['user_pk'])
-            group = get_object_or_404(Group, pk=self.kwargs['group_pk'])
+            group = get_object_or_404(Group, pk=self.kwargs['group_pk'], entity_role__entity=entity) # Only the entity's own groups
             user.groups.remove(group)
         return redirect(self.request.path)
 
@@ -149,6 +278,24 @@ class EntityUpdateView(EntityMixin, UpdateView):
         return self.model.get_objects_for_user(self.request.user, settings.ENTITY_PERM_CHANGE)
 
 
+class EntityMoveView(EntityMixin, UpdateView):
+    # Moves the entity and everything below it to another parent through Entity.move_to, for non top level models
+    fields = ['parent']
+    template_name = 'entity_move.html'
+
+    def get_queryset(self):
+        return self.model.get_objects_for_user(self.request.user, settings.ENTITY_PERM_CHANGE)
+
+    def get_form(self, form_class=None):
+        form = super().get_form(form_class)
+        form.fields['parent'].queryset = self.model.get_parent_model().get_objects_for_user(self.request.user, settings.ENTITY_PERM_CHANGE)
+        return form
+
+    def form_valid(self, form):
+        self.object.move_to(form.cleaned_data['parent'])
+        return redirect(self.object.get_absolute_url())
+
+
 class EntityDeleteView(EntityMixin, DeleteView):
     def get_queryset(self):
         return self.model.get_objects_for_user(self.request.user, settings.ENTITY_PERM_DELETE)
@@ -212,6 +359,10 @@ class BusinessUpdateView(EntityUpdateView):
     context_object_name = 'business'
 
 
+class BusinessMoveView(EntityMoveView):
+    model = Business
+
+
 class BusinessDeleteView(EntityDeleteView):
     model = Business
     template_name = 'business_confirm_delete.html'
@@ -244,6 +395,10 @@ class BranchUpdateView(EntityUpdateView):
     context_object_name = 'branch'
 
 
+class BranchMoveView(EntityMoveView):
+    model = Branch
+
+
 class BranchDeleteView(EntityDeleteView):
     model = Branch
     template_name = 'branch_confirm_delete.html'
@@ -0,0 +1,7 @@
+import os
+
+# PLATTER_ENV=prod selects the production settings, anything else the development ones
+if os.environ.get('PLATTER_ENV', 'dev') == 'prod':
+    from .prod import *  # noqa
+else:
+    from .dev import *  # noqa
@@ -0,0 +1,238 @@
+"""
+Django settings for plattersystems project, shared by dev.py and prod.py. plattersystems.settings picks one of
+those from the PLATTER_ENV environment variable.
+
+Generated by 'django-admin startproject' using Django 4.2.8.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/topics/settings/
+
+For the full list of settings and their values, see
+https://docs.djangoproject.com/en/4.2/ref/settings/
+"""
+
+import os
+from pathlib import Path
+
+# Build paths inside the project like this: BASE_DIR / 'subdir'.
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+
+# Quick-start development settings - unsuitable for production
+# See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
+
+# SECURITY WARNING: keep the secret key used in production secret!
+SECRET_KEY = os.environ.get('PLATTER_SECRET_KEY', 'django-insecure-yf9zo2h@ji8pnwr379g%$&l3ree9wn(x407kr+jy9^31-*b@8a')
+
+# SECURITY WARNING: don't run with debug turned on in production!
+DEBUG = False
+
+ALLOWED_HOSTS = []
+
+
+# Application definition
+
+INSTALLED_APPS = [
+    'django.contrib.admin',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django.contrib.staticfiles',
+    'guardian',
+    'multiuser',
+]
+
+MIDDLEWARE = [
+    'multiuser.instrumentation.InstrumentationMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+]
+
+ROOT_URLCONF = 'plattersystems.urls'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [
+            BASE_DIR / "plattersystems" / "templates",
+        ],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.debug',
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    },
+]
+
+WSGI_APPLICATION = 'plattersystems.wsgi.application'
+
+
+# Database
+# https://docs.djangoproject.com/en/4.2/ref/settings/#databases
+
+# PLATTER_DB selects the database: sqlite (the default) or postgresql, configured from the other PLATTER_DB_* variables
+
+PLATTER_DB = os.environ.get('PLATTER_DB', 'sqlite')
+
+if PLATTER_DB == 'postgresql':
+    # With PLATTER_DB_POOL=1 connections come from a psycopg pool (needs psycopg[pool]), otherwise each worker keeps
+    # its connection open for CONN_MAX_AGE seconds. Django doesn't allow both at once
+    DB_POOL = os.environ.get('PLATTER_DB_POOL', '1') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('PLATTER_DB_NAME', 'platter'),
+            'USER': os.environ.get('PLATTER_DB_USER', ''),
+            'PASSWORD': os.environ.get('PLATTER_DB_PASSWORD', ''),
+            'HOST': os.environ.get('PLATTER_DB_HOST', ''),
+            'PORT': os.environ.get('PLATTER_DB_PORT', ''),
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('PLATTER_DB_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('PLATTER_DB_POOL_MIN_SIZE', '2')),
+                    'max_size': int(os.environ.get('PLATTER_DB_POOL_MAX_SIZE', '10')),
+                    'timeout': 10,
+                },
+            } if DB_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('PLATTER_DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Take the write lock when the transaction starts, so that concurrent transactions wait for each
+                # other (up to busy_timeout) rather than fail when a read lock can't be upgraded
+                'transaction_mode': 'IMMEDIATE',
+            },
+        }
+    }
+
+# Set on every new SQLite connection by multiuser.signals.configure_sqlite. WAL lets reads go on while a write is
+# in progress, and synchronous=NORMAL is safe with WAL. PLATTER_SQLITE_PRAGMAS=0 leaves SQLite's defaults
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'busy_timeout': 5000, # Milliseconds to wait for the write lock
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+} if os.environ.get('PLATTER_SQLITE_PRAGMAS', '1') == '1' else {}
+
+
+# Password validation
+# https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
+
+AUTH_PASSWORD_VALIDATORS = [
+    {
+        'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
+    },
+    {
+        'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator',
+    },
+    {
+        'NAME': 'django.contrib.auth.password_validation.CommonPasswordValidator',
+    },
+    {
+        'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator',
+    },
+]
+
+
+# Internationalization
+# https://docs.djangoproject.com/en/4.2/topics/i18n/
+
+LANGUAGE_CODE = 'en-us'
+
+TIME_ZONE = 'UTC'
+
+USE_I18N = True
+
+USE_TZ = True
+
+
+# Static files (CSS, JavaScript, Images)
+# https://docs.djangoproject.com/en/4.2/howto/static-files/
+
+STATIC_URL = 'static/'
+
+# Default primary key field type
+# https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
+
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+AUTHENTICATION_BACKENDS = (
+    "django.contrib.auth.backends.ModelBackend",
+    "guardian.backends.ObjectPermissionBackend",
+)
+
+# Background tasks, see multiuser/tasks.py. ImmediateBackend runs them inline after the transaction commits,
+# ThreadPoolBackend runs them in a thread pool in the web process, DatabaseBackend queues them in the Task table
+# for `manage.py run_tasks`. Only DatabaseBackend keeps the tasks, e.g. the group cleanup of deleted entities,
+# when the web process exits
+TASK_BACKEND = 'multiuser.tasks.DatabaseBackend'
+TASK_THREADS = 4
+TASK_MAX_ATTEMPTS = 3
+TASK_RETRY_DELAY = 10 # Seconds before the first retry, doubled for every further attempt
+TASK_LEASE_TIMEOUT = 600 # Seconds after which a task still running is taken to have lost its worker, and is retried
+
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Per-request query count, database time and permission resolution time, see multiuser/instrumentation.py
+INSTRUMENTATION_SAMPLE_RATE = 0.1 # Fraction of requests measured, 0 turns the middleware off
+INSTRUMENTATION_SERVER_TIMING = False # Adds the measurements to the response in a Server-Timing header
+
+# Rows per page in the entity and invitation lists
+LIST_PAGE_SIZE = 50
+
+LOGIN_REDIRECT_URL = "/multiuser/organisation/"
+LOGOUT_REDIRECT_URL = "/accounts/login/"
+
+ENTITY_ROLE_ADMIN = 'Admin'
+ENTITY_ROLE_USER = 'User'
+
+ENTITY_PERM_VIEW = 'view'
+ENTITY_PERM_CHANGE = 'change'
+ENTITY_PERM_DELETE = 'delete'
+
+ENTITY_ROLES = {
+    ENTITY_ROLE_ADMIN: {
+        'permissions': [ENTITY_PERM_VIEW, ENTITY_PERM_CHANGE, ENTITY_PERM_DELETE],
+        'group_name': 'admins',
+    },
+    ENTITY_ROLE_USER: {
+        'permissions': [ENTITY_PERM_VIEW],
+        'group_name': 'users',
+    },
+}
+
+ENTITY_HIERARCHY = [
+    "Organisation",
+    "Business",
+    "Branch",
+]
+
+# Seconds to keep each user's effective entity permissions in the cache framework. 0 only memoizes them for
+# the current request. Use a cache shared by all processes (not the default LocMemCache) when enabling this,
+# otherwise invalidations in one process will not reach the others
+ENTITY_PERMS_CACHE_TIMEOUT = 0
+
+# Seconds to keep the children lists and users panels of the entity pages as template fragments, see
+# multiuser/fragments.py. 0 turns the fragment cache off. The same caveat about a shared cache applies
+FRAGMENT_CACHE_TIMEOUT = 0
+
+# Derive the ETags of the JSON API from a version bumped on every change, see multiuser/etags.py, so that unchanged
+# polls get a 304 without running the view's queries. Off, the ETag is a hash of the rendered body. Needs a shared
+# cache like the caches above
+API_VERSION_ETAGS = False
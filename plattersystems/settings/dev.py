@@ -0,0 +1,17 @@
+from .base import *  # noqa
+
+PLATTER_ENV = 'dev'
+
+DEBUG = True
+
+INSTALLED_APPS = [*INSTALLED_APPS, 'debug_toolbar']
+
+MIDDLEWARE = ['debug_toolbar.middleware.DebugToolbarMiddleware', *MIDDLEWARE]
+
+INTERNAL_IPS = [
+    '127.0.0.1',
+]
+
+INSTRUMENTATION_SERVER_TIMING = True
+
+TASK_BACKEND = 'multiuser.tasks.ImmediateBackend' # So that the development server needs no worker
@@ -0,0 +1,38 @@
+from copy import deepcopy
+from .base import *  # noqa
+
+# No debug toolbar, and DEBUG off so that connections don't keep every executed query in memory.
+# multiuser.checks warns at startup if any of that comes back
+
+PLATTER_ENV = 'prod'
+
+DEBUG = False
+
+SECRET_KEY = os.environ['PLATTER_SECRET_KEY']
+
+ALLOWED_HOSTS = [host for host in os.environ.get('PLATTER_ALLOWED_HOSTS', '').split(',') if host]
+
+INSTRUMENTATION_SAMPLE_RATE = float(os.environ.get('PLATTER_INSTRUMENTATION_SAMPLE_RATE', '0.01'))
+
+# Compile each template once per process
+TEMPLATES = deepcopy(TEMPLATES)
+TEMPLATES[0]['APP_DIRS'] = False
+TEMPLATES[0]['OPTIONS']['loaders'] = [
+    ('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]),
+]
+
+# The permission and fragment caches are invalidated by bumping versions in the cache, so every worker must share it
+if os.environ.get('PLATTER_CACHE_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': os.environ.get('PLATTER_CACHE_BACKEND', 'django.core.cache.backends.redis.RedisCache'),
+            'LOCATION': os.environ['PLATTER_CACHE_LOCATION'],
+        },
+    }
+
+ENTITY_PERMS_CACHE_TIMEOUT = int(os.environ.get('PLATTER_ENTITY_PERMS_CACHE_TIMEOUT', '0'))
+FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('PLATTER_FRAGMENT_CACHE_TIMEOUT', '0'))
+API_VERSION_ETAGS = os.environ.get('PLATTER_API_VERSION_ETAGS', '0') == '1'
@@ -14,6 +14,7 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 from . import views
@@ -24,5 +25,7 @@ urlpatterns = [
     path('sign-up', views.sign_up, name='sign_up'),
     path('multiuser/', include('multiuser.urls')),
     path('', views.home, name='home'),
-    path('__debug__/', include('debug_toolbar.urls')),
 ]
+
+if 'debug_toolbar' in settings.INSTALLED_APPS: # Only in the development settings
+    urlpatterns.append(path('__debug__/', include('debug_toolbar.urls')))